@@ -0,0 +1,147 @@
+"""
+Bulk runner for robustness evaluation over a corpus of test cases.
+
+Reads a JSONL file of cases, one JSON object per line:
+
+    {"id": "case-1", "injection": "...", "mandatory_text": "...", "config": {"optimization": {"max_iterations": 500}}}
+
+"injection" and "mandatory_text" default to the values in config.yaml and "config" overrides
+config.yaml for that case only (except the "model" and "cache" sections and the "database"
+section apart from context_stats, which are set once per run). Up to --concurrency cases are searched at the same time: their
+trajectories share the single loaded model and are advanced together in batched steps. One JSONL
+result line is written per case as soon as it finishes. Invalid lines, invalid settings and cases
+whose search keeps failing get a result line with an "error" instead.
+"""
+
+import argparse
+import json
+import traceback
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple
+
+from hacking import SearchJob, load_settings, step_jobs, text_config
+
+
+def read_cases(path: str) -> Iterator[Tuple[int, Any]]:
+    """
+    Yield (line number, case) for every non-empty line of a JSONL file. Lines that are not
+    valid JSON yield the JSONDecodeError instead of a case.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, e
+
+
+def start_job(case_id: Any, case: Dict[str, Any]) -> SearchJob:
+    """Create the search job for a case."""
+    return SearchJob(
+        case.get("injection", text_config["injection"]),
+        case.get("mandatory_text", text_config["mandatory"]),
+        load_settings(case.get("config")),
+        name=str(case_id),
+    )
+
+
+def write_result(out: IO[str], result: Dict[str, Any]) -> None:
+    """Append one result line and flush it so partial runs keep their results."""
+    out.write(json.dumps(result) + "\n")
+    out.flush()
+
+
+def run_cases(path: str, out: IO[str], concurrency: int = 4) -> None:
+    """
+    Run every case of a JSONL file, keeping up to `concurrency` searches in flight.
+
+    Parameters:
+    -----------
+    path: JSONL file of cases
+    out: Stream that receives one JSON result line per case
+    concurrency: Maximum number of cases searched side by side
+    """
+    cases = read_cases(path)
+    active: List[SearchJob] = []
+    case_ids: Dict[SearchJob, Any] = {}
+    exhausted: bool = False
+
+    while True:
+        # Admit new cases until the concurrency limit is reached
+        while not exhausted and len(active) < concurrency:
+            case: Optional[Tuple[int, Any]] = next(cases, None)
+            if case is None:
+                exhausted = True
+                break
+            line_number, case_data = case
+            if not isinstance(case_data, dict):
+                error = (
+                    f"Invalid case line: {case_data}"
+                    if isinstance(case_data, json.JSONDecodeError)
+                    else "Invalid case line: expected a JSON object"
+                )
+                write_result(out, {"id": line_number, "error": error})
+                continue
+            case_id = case_data.get("id", line_number)
+            try:
+                job: SearchJob = start_job(case_id, case_data)
+            except Exception as e:
+                traceback.print_exc()
+                write_result(out, {"id": case_id, "error": str(e)})
+                continue
+            active.append(job)
+            case_ids[job] = case_id
+
+        if not active:
+            break
+
+        step_jobs(active)
+
+        for job in [job for job in active if job.done]:
+            active.remove(job)
+            if job.error is not None:
+                # The job's search steps kept failing; the other cases carried on without it
+                result: Dict[str, Any] = {"error": job.error}
+            else:
+                try:
+                    result = job.finish()
+                except Exception as e:
+                    traceback.print_exc()
+                    result = {"error": str(e)}
+            write_result(
+                out,
+                {
+                    "id": case_ids.pop(job),
+                    "injection": job.injection_text,
+                    "mandatory_text": job.text,
+                    **result,
+                },
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many optimization cases from a JSONL file")
+    parser.add_argument("cases", type=str, help="JSONL file with one case per line")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="results.jsonl",
+        help="JSONL file that receives one result line per case",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of cases searched side by side in shared batches",
+    )
+    args = parser.parse_args()
+
+    with open(args.output, "w", encoding="utf-8") as out:
+        run_cases(args.cases, out, concurrency=max(1, args.concurrency))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import string
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import AutoTokenizer
+
+
+class PromptEncoder:
+    """
+    Token-level view of the prompt template for one (injection, mandatory text) pair.
+
+    The fixed segments of the template are tokenized once. Input ids for any prefix are then
+    assembled by splicing the prefix token ids between the cached segment ids, so only the prefix
+    is ever tokenized in the hot loop and the span of the prefix in the sequence is known exactly.
+
+    Segments are tokenized independently, so a token that would merge across a segment boundary
+    in the joined string is split here. Final results are always re-checked on the joined string.
+    """
+
+    def __init__(
+        self,
+        tokenizer: AutoTokenizer,
+        injection_text: str,
+        text: str,
+        order_template: str = "{injection}{prefix}{text}",
+        cache_size: int = 4096,
+    ):
+        self.tokenizer = tokenizer
+        self.injection_text = injection_text
+        self.text = text
+        self.order_template = order_template
+        self.cache_size = cache_size
+        self._prefix_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+
+        values: Dict[str, str] = {"injection": injection_text, "text": text}
+        before: List[int] = []
+        after: List[int] = []
+        seen_prefix: bool = False
+        for literal, field, _, _ in string.Formatter().parse(order_template):
+            segments: List[str] = [literal] if literal else []
+            if field == "prefix":
+                if seen_prefix:
+                    raise ValueError(f"Template must contain {{prefix}} once: {order_template}")
+                (after if seen_prefix else before).extend(self._encode_segments(segments))
+                seen_prefix = True
+                continue
+            if field is not None:
+                if field not in values:
+                    raise ValueError(f"Unknown template field '{field}' in: {order_template}")
+                segments.append(values[field])
+            (after if seen_prefix else before).extend(self._encode_segments(segments))
+        if not seen_prefix:
+            raise ValueError(f"Template must contain {{prefix}}: {order_template}")
+
+        # Special tokens wrapping the sequence, e.g. [CLS] ... [SEP]
+        self.head_ids: List[int] = (
+            [tokenizer.cls_token_id] if tokenizer.cls_token_id is not None else []
+        )
+        self.tail_ids: List[int] = (
+            [tokenizer.sep_token_id] if tokenizer.sep_token_id is not None else []
+        )
+        self.before_ids: List[int] = self.head_ids + before
+        self.after_ids: List[int] = after + self.tail_ids
+
+        self.max_length: Optional[int] = max_input_length(tokenizer)
+
+    def _encode_segments(self, segments: Sequence[str]) -> List[int]:
+        """Tokenize fixed template segments without special tokens."""
+        ids: List[int] = []
+        for segment in segments:
+            if segment:
+                ids.extend(self.tokenizer(segment, add_special_tokens=False)["input_ids"])
+        return ids
+
+    def encode_prefix(self, prefix: str) -> List[int]:
+        """Token ids of a prefix, cached since the search revisits the same prefixes."""
+        ids: Optional[List[int]] = self._prefix_cache.get(prefix)
+        if ids is not None:
+            self._prefix_cache.move_to_end(prefix)
+            return ids
+        ids = self.tokenizer(prefix, add_special_tokens=False)["input_ids"]
+        self._prefix_cache[prefix] = ids
+        if len(self._prefix_cache) > self.cache_size:
+            self._prefix_cache.popitem(last=False)
+        return ids
+
+    def control_slice(self, prefix_length: int) -> slice:
+        """Slice of the prefix tokens inside the assembled sequence."""
+        start: int = len(self.before_ids)
+        return slice(start, start + prefix_length)
+
+    def fits(self, prefix_length: int) -> bool:
+        """Whether a prefix of this many tokens leaves the whole template inside max_length."""
+        length: int = len(self.before_ids) + prefix_length + len(self.after_ids)
+        return self.max_length is None or length <= self.max_length
+
+    def build_ids(self, prefix_ids: Sequence[int]) -> List[int]:
+        """Assemble the full input ids for a prefix, truncated like the tokenizer would."""
+        ids: List[int] = self.before_ids + list(prefix_ids) + self.after_ids
+        if self.max_length is not None and len(ids) > self.max_length:
+            ids = ids[: self.max_length - len(self.tail_ids)] + self.tail_ids
+        return ids
+
+    def build(
+        self, prefix_ids: Sequence[int], device: Optional[torch.device] = None
+    ) -> Tuple[torch.Tensor, slice]:
+        """
+        Assemble the input ids for a single prefix.
+
+        Returns:
+        --------
+        input_ids: 1-D tensor of token ids including special tokens
+        control_slice: Slice of the prefix tokens inside input_ids
+        """
+        input_ids = torch.tensor(self.build_ids(prefix_ids), dtype=torch.long, device=device)
+        return input_ids, self.control_slice(len(prefix_ids))
+
+
+def max_input_length(tokenizer: AutoTokenizer) -> Optional[int]:
+    """Maximum sequence length of the tokenizer's model, None if it has no limit."""
+    # Tokenizers without a limit report a huge sentinel value
+    model_max_length: int = getattr(tokenizer, "model_max_length", 0) or 0
+    return model_max_length if 0 < model_max_length < 100_000 else None
+
+
+def pad_batch(
+    ids_list: Sequence[Sequence[int]],
+    pad_token_id: int,
+    device: Optional[torch.device] = None,
+) -> Dict[str, torch.Tensor]:
+    """Right-pad assembled sequences into model inputs (input_ids and attention_mask)."""
+    max_len: int = max(len(ids) for ids in ids_list)
+    input_ids = torch.full((len(ids_list), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(ids_list), max_len), dtype=torch.long)
+    for row, ids in enumerate(ids_list):
+        input_ids[row, : len(ids)] = torch.as_tensor(list(ids), dtype=torch.long)
+        attention_mask[row, : len(ids)] = 1
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
@@ -1,24 +1,34 @@
 import os
+import sys
 import torch
-import torch.nn as nn
 import random
 import string
 import tiktoken
 import argparse
+import time
+import traceback
 import yaml
-from typing import List, Dict, Tuple, Any, Optional
+from typing import Callable, List, Dict, Tuple, Any, Optional
 from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
-from huggingface_hub import login
+from huggingface_hub import get_token, login
 from words import words
+from encoder import PromptEncoder
+from wordsdb import context_key
+from profiler import profiler
+from vocab_filter import token_ids
+from score_cache import score_cache
 from utils import (
     minimize_tokens,
+    classify_ids,
     sample_control,
     count_tokens,
+    count_tokens_batch,
     get_random_words,
-    token_gradients_combined,
+    token_gradients_batch,
     find_best_word_to_add,
     words_db,
-    get_filtered_cands,
+    consistent_cands_mask,
+    score_candidates,
 )
 from dotenv import load_dotenv
 
@@ -33,6 +43,19 @@ prefix_config = config["prefix"]
 stagnation_config = config["stagnation"]
 scoring_config = config["scoring"]
 text_config = config["text"]
+database_config = config.get("database", {})
+
+# Buffered (optionally background) writes to the word performance database
+words_db.configure(
+    buffer_size=database_config.get("buffer_size"),
+    background=database_config.get("background_writes"),
+    max_rows=database_config.get("retention_rows"),
+    max_days=database_config.get("retention_days"),
+    store_raw=database_config.get("store_raw"),
+)
+
+# Classifier results are cached by input ids across candidates, jobs and minimization
+score_cache.configure(max_size=config.get("cache", {}).get("max_size"))
 
 # check if cuda is available
 use_gpu = model_config.get("use_gpu", torch.cuda.is_available())
@@ -46,27 +69,158 @@ if model_config.get("load_hf_token_from_env", False):
 hf_token = os.getenv("HF_TOKEN")
 if hf_token:
     login(token=hf_token)
-else:
+elif sys.stdin.isatty():
     login()
+elif get_token() is None:
+    # Without a terminal there is nobody to prompt, and stdin may carry jobs (see worker.py)
+    raise RuntimeError(
+        "HF_TOKEN is not set and there is no saved Hugging Face login; set HF_TOKEN "
+        "(or load_hf_token_from_env with a .env file) or run `huggingface-cli login` first"
+    )
+
+
+# Settings applied once when this module is loaded, which a job's overrides cannot change.
+# None means the whole section; database.context_stats is a per-job setting
+PROCESS_SETTINGS: Dict[str, Optional[Tuple[str, ...]]] = {
+    "model": None,
+    "cache": None,
+    "database": ("buffer_size", "background_writes", "retention_rows", "retention_days", "store_raw"),
+}
+
+# Accepted values of the settings that select a strategy, with their config.yaml key
+SETTING_CHOICES: Dict[str, Tuple[str, Tuple[Any, ...]]] = {
+    "gradient_mode": ("optimization.gradient_mode", ("one_hot", "embedding")),
+    "insert_positions": ("stagnation.insert_positions", ("fixed", "all")),
+    "minimization_strategy": ("minimization.strategy", ("greedy", "block")),
+    "minimization_attribution": (
+        "minimization.attribution",
+        (None, "gradient_x_input", "integrated_gradients"),
+    ),
+    "position_strategy": ("sampling.positions", ("strided", "random", "gradient")),
+    "truncation": ("evaluation.truncation", ("refuse", "flag")),
+}
+
+
+def load_settings(overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Resolve the search parameters from config.yaml, optionally overridden per job.
+
+    Parameters:
+    -----------
+    overrides: Nested dict using the same sections as config.yaml, e.g. {"optimization": {"alpha": 0.5}}
+
+    Returns:
+    --------
+    Flat dict of the parameters used by the search
+
+    Raises:
+    -------
+    ValueError: If the overrides change a process-wide setting (see PROCESS_SETTINGS) or a
+                setting that selects a strategy has an unknown value (see SETTING_CHOICES)
+    """
+    sections: Dict[str, Dict[str, Any]] = {
+        name: dict(values) for name, values in config.items() if isinstance(values, dict)
+    }
+    for name, values in (overrides or {}).items():
+        if name in PROCESS_SETTINGS:
+            fixed: List[str] = [
+                key for key in values if PROCESS_SETTINGS[name] is None or key in PROCESS_SETTINGS[name]
+            ]
+            if fixed:
+                raise ValueError(
+                    f"{', '.join(f'{name}.{key}' for key in fixed)} can only be set in config.yaml, "
+                    f"not per job"
+                )
+        sections.setdefault(name, {}).update(values)
+
+    optimization = sections["optimization"]
+    prefix = sections["prefix"]
+    stagnation = sections["stagnation"]
+    scoring = sections["scoring"]
+    minimization = sections.get("minimization", {})
+    vocabulary = sections.get("vocabulary", {})
+    sampling = sections.get("sampling", {})
+    evaluation = sections.get("evaluation", {})
+    settings: Dict[str, Any] = {
+        "alpha": optimization["alpha"],
+        "min_benign_confidence": optimization["min_benign_confidence"],
+        "improvement_threshold": optimization["improvement_threshold"],
+        "max_iterations": optimization["max_iterations"],
+        "patience": optimization["patience"],
+        # Define token penalty weight - higher values penalize longer prefixes more
+        "token_penalty_weight": optimization["token_penalty_weight"],
+        "min_acceptable_benign": optimization["min_acceptable_benign"],
+        "restarts": max(1, int(optimization.get("restarts", 1))),
+        # Drop candidates whose decoded text does not re-encode to the same tokens
+        "filter_candidates": optimization.get("filter_candidates", False),
+        # "one_hot" or "embedding" (gradient w.r.t. the prefix embeddings, projected onto the
+        # vocabulary in chunks of vocab_chunk_size rows, without the one-hot matrix)
+        "gradient_mode": optimization.get("gradient_mode", "one_hot"),
+        "vocab_chunk_size": optimization.get("vocab_chunk_size", 8192),
+        "words_to_inject": prefix["words_to_inject"],
+        # Number of words to use in the initial prefix
+        "init_prefix_words_count": prefix["init_words_count"],
+        # How much to prioritize token count vs improvement (higher = more focus on tokens)
+        "init_token_priority": prefix["init_token_priority"],
+        "general_token_priority": prefix["general_token_priority"],
+        # Define a threshold for injecting educational text when optimization stagnates
+        "stagnation_threshold": stagnation["threshold"],
+        "grace_period": stagnation["grace_period"],
+        # Candidates per forward pass in the stagnation word search ("auto" = from free memory)
+        "word_batch_size": stagnation.get("batch_size", "auto"),
+        # "fixed" tries beginning/middle/end, "all" tries every word boundary
+        "insert_positions": stagnation.get("insert_positions", "fixed"),
+        "rolling_window_size": scoring["rolling_window_size"],
+        "max_top_scores": scoring["max_top_scores"],
+        "rolling_weight": scoring["rolling_weight"],
+        "top_weight": scoring["top_weight"],
+        # Score all leave-one-out variants of a minimization round in one forward pass
+        "batched_minimization": minimization.get("batched", True),
+        # "greedy" removes one token per round, "block" removes blocks with bisection backoff
+        "minimization_strategy": minimization.get("strategy", "greedy"),
+        # Gradient attribution ("gradient_x_input" or "integrated_gradients") used to only
+        # evaluate the removals of the lowest-contribution tokens
+        "minimization_attribution": minimization.get("attribution"),
+        "attribution_candidates": minimization.get("attribution_candidates", 8),
+        # Keep word statistics per search context, falling back to global statistics
+        "context_stats": sections.get("database", {}).get("context_stats", True),
+        # Candidates per trajectory and iteration, always filled with distinct candidates
+        "candidate_batch_size": sampling.get("batch_size", 32),
+        # Best tokens per position to sample replacements from
+        "candidate_topk": sampling.get("topk", 16),
+        # Temperature of the gradient-weighted position choice
+        "candidate_temperature": sampling.get("temperature", 1.5),
+        # Tokens replaced per candidate and how their positions are picked
+        # ("strided", "random" or "gradient")
+        "num_coordinates": sampling.get("num_coordinates", 1),
+        "position_strategy": sampling.get("positions", "strided"),
+        # Filters of the tokens sample_control may propose (None disables the filter)
+        "vocab_filters": (
+            {
+                name: vocabulary[name]
+                for name in ("ascii_only", "word_start_only", "from_words", "max_tiktoken_cost")
+                if name in vocabulary
+            }
+            if vocabulary.get("enabled", True)
+            else None
+        ),
+        "vocab_cache_dir": vocabulary.get("cache_dir", ".vocab_cache"),
+        # Padded tokens per forward pass; sequences are batched by length (None = no limit)
+        "max_batch_tokens": evaluation.get("max_batch_tokens"),
+        # "refuse" or "flag" candidates whose text exceeds the model's input length
+        "truncation": evaluation.get("truncation", "refuse"),
+        # Layout of the components, using {injection}, {prefix} and {text}
+        "order_template": sections["text"].get("order_template", "{injection}{prefix}{text}"),
+    }
+
+    # Reject typos here, where they fail the job that has them, rather than in the shared steps
+    for name, (key, choices) in SETTING_CHOICES.items():
+        if settings[name] not in choices:
+            raise ValueError(
+                f"Invalid {key}: {settings[name]!r} (expected one of {', '.join(map(repr, choices))})"
+            )
+    return settings
 
-alpha: float = optimization_config["alpha"]
-min_benign_confidence: float = optimization_config["min_benign_confidence"]
-words_to_inject: int = prefix_config["words_to_inject"]
-improvement_threshold: float = optimization_config["improvement_threshold"]
-rolling_window_size: int = scoring_config["rolling_window_size"]
-
-# Define a threshold for injecting educational text when optimization stagnates
-stagnation_threshold: int = stagnation_config["threshold"]
-grace_period: int = stagnation_config["grace_period"]
-max_iterations: int = optimization_config["max_iterations"]
-patience: int = optimization_config["patience"]
-max_top_scores: int = scoring_config["max_top_scores"]
-rolling_weight: float = scoring_config["rolling_weight"]
-top_weight: float = scoring_config["top_weight"]
-
-# Define token penalty weight - higher values penalize longer prefixes more
-token_penalty_weight: float = optimization_config["token_penalty_weight"]
-min_acceptable_benign: float = optimization_config["min_acceptable_benign"]
 
 model_id: str = model_config["id"]
 # model_id = "meta-llama/Llama-Prompt-Guard-2-22M"
@@ -94,377 +248,855 @@ if benign_class_idx is None:
 if malicious_class_idx is None:
     malicious_class_idx = 1  # Assuming binary classification with malicious=0
 
-injection_text = text_config["injection"]
-text: str = text_config["mandatory"]
 
-# Number of words to use in the initial prefix
-init_prefix_words_count: int = prefix_config["init_words_count"]
-# How much to prioritize token count vs improvement (higher = more focus on tokens)
-init_token_priority: float = prefix_config["init_token_priority"]
-general_token_priority: float = prefix_config["general_token_priority"]
-
-# Try to use top-performing words from the database for the initial prefix
-top_words = words_db.get_top_words(
-    limit=init_prefix_words_count, min_uses=1, token_weight=init_token_priority
-)
-if top_words:
-    print(f"Using {len(top_words)} top-performing words from database for initial prefix")
-    # Get words with combined token and improvement prioritization
-    initial_words = get_random_words(
-        n=init_prefix_words_count,
-        min_uses=1,  # Words must have been tested at least once
-        token_priority=init_token_priority,
+def initial_prefix(count: int, token_priority: float, context: Optional[str] = None) -> str:
+    """Build the initial prefix, preferring top-performing words from the database."""
+    # Try to use top-performing words from the database for the initial prefix
+    top_words = words_db.get_top_words(
+        limit=count, min_uses=1, token_weight=token_priority, context=context
     )
-    init_prefix: str = " ".join(initial_words)
-    print(
-        f"Created initial prefix using database-informed words (token priority: {init_token_priority})"
-    )
-else:
+    if top_words:
+        print(f"Using {len(top_words)} top-performing words from database for initial prefix")
+        # Get words with combined token and improvement prioritization
+        initial_words = get_random_words(
+            n=count,
+            min_uses=1,  # Words must have been tested at least once
+            token_priority=token_priority,
+            context=context,
+        )
+        print(
+            f"Created initial prefix using database-informed words (token priority: {token_priority})"
+        )
+        return " ".join(initial_words)
+
     # Fall back to random words if the database doesn't have enough data
-    init_prefix: str = " ".join(words[:init_prefix_words_count])
     print(f"Using random words for initial prefix (no database history available)")
+    return " ".join(words[:count])
+
+
+class SearchState:
+    """
+    Mutable state of a single search trajectory. Several trajectories (restarts) are advanced
+    side by side so that their gradients and candidates share batched model calls.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        encoder: PromptEncoder,
+        settings: Dict[str, Any],
+        label: str = "",
+        context: Optional[str] = None,
+    ):
+        self.label = label
+        self.settings = settings
+        self.encoder = encoder
+        self.context = context  # Key of the word statistics for this search (see context_key)
+        self.injection_text = encoder.injection_text
+        self.text = encoder.text
+        self.set_prefix(prefix)
+
+        self.best_score: float = float("-inf")
+        self.best_prefix: Optional[str] = None
+        self.best_iteration_score: float = float("-inf")
+        self.iterations_without_improvement: int = 0
+        self.found_high_confidence_benign: bool = False
+        self.active: bool = True
+        self.benign_score: float = 0.0  # Benign probability of the current prefix
+        self.iteration: int = 0  # Number of completed iterations
+        self.scored: bool = False  # Whether the current prefix went through update_state
+
+        # Track both rolling and top scores
+        self.rolling_scores: List[float] = []  # List to store recent scores
+        self.top_scores: List[float] = []  # List to store top scores
+
+        # Track token counts
+        self.current_token_count: int = count_tokens(prefix)
+        self.min_token_count: int = self.current_token_count
+
+    def set_prefix(self, prefix: str) -> None:
+        """Replace the prefix and re-derive its tokens."""
+        self.scored = False
+        self.adv_prefix = prefix
+        self.adv_prefix_tokens: torch.Tensor = torch.tensor(
+            self.encoder.encode_prefix(prefix), dtype=torch.long, device=device
+        )
+        # Slice representing the prefix tokens in the assembled input
+        self.control_slice: slice = self.encoder.control_slice(len(self.adv_prefix_tokens))
+
+    def set_prefix_tokens(self, prefix_tokens: List[int], prefix: str) -> None:
+        """Replace the prefix by candidate tokens, keeping them as the source of truth."""
+        self.adv_prefix = prefix
+        self.adv_prefix_tokens = torch.tensor(prefix_tokens, dtype=torch.long, device=device)
+        self.control_slice = self.encoder.control_slice(len(self.adv_prefix_tokens))
+
+    def fits(self, prefix: str) -> bool:
+        """Whether a prefix leaves the whole template inside the model's input length."""
+        return self.encoder.fits(len(self.encoder.encode_prefix(prefix)))
+
+    def input_ids(self) -> List[int]:
+        """Full input ids for the current prefix."""
+        return self.encoder.build_ids(self.adv_prefix_tokens.tolist())
+
+
+def restart_prefix(n: int) -> str:
+    """Random initial prefix used to diversify the restarts after the first one."""
+    return " ".join(random.choices(words, k=n))
+
+
+def update_state(state: SearchState, logits: torch.Tensor, i: int) -> bool:
+    """
+    Per-iteration bookkeeping for one trajectory given the logits of its current prefix:
+    rolling/top scores, patience, stagnation handling and best-prefix tracking.
+
+    Returns True if the trajectory found a high confidence benign classification.
+    """
+    settings: Dict[str, Any] = state.settings
+    alpha: float = settings["alpha"]
+    improvement_threshold: float = settings["improvement_threshold"]
+    patience: int = settings["patience"]
+    stagnation_threshold: int = settings["stagnation_threshold"]
+    grace_period: int = settings["grace_period"]
+    rolling_window_size: int = settings["rolling_window_size"]
+    max_top_scores: int = settings["max_top_scores"]
+    general_token_priority: float = settings["general_token_priority"]
 
-# init_prefix = "".join(random.choices(words, k=init_prefix_words_count))
-
+    predicted_class_id: int = logits.argmax().item()
 
-def main():
-    global injection_text, text, init_prefix_words_count
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description="Prompt hacking tool")
-    parser.add_argument(
-        "--injection",
-        type=str,
-        default=text_config["injection"],
-        help="Injection text to use in the template",
+    # Calculate combined score (no token penalty for the current prefix)
+    scores: Dict[str, torch.Tensor] = score_candidates(
+        logits.unsqueeze(0), benign_class_idx, alpha=alpha
     )
-    parser.add_argument(
-        "--mandatory-text",
-        type=str,
-        default=text_config["mandatory"],
-        help="Mandatory text to use in the template",
-    )
-    parser.add_argument(
-        "--init-prefix-words-count",
-        type=int,
-        default=prefix_config["init_words_count"],
-        help="Number of words to use in the initial prefix",
+    benign_score: float = scores["benign"][0].item()
+    benign_percentage: float = benign_score * 100
+    normalized_loss: float = scores["normalized_loss"][0].item()
+    current_score: float = scores["combined"][0].item()
+    state.benign_score = benign_score
+    state.scored = True
+
+    # Update rolling average
+    state.rolling_scores.append(current_score)
+    if len(state.rolling_scores) > rolling_window_size:
+        state.rolling_scores.pop(0)  # Remove oldest score
+    rolling_avg: float = sum(state.rolling_scores) / len(state.rolling_scores)
+
+    # Update top scores
+    state.top_scores.append(current_score)
+    state.top_scores.sort(reverse=True)  # Sort in descending order
+    if len(state.top_scores) > max_top_scores:
+        state.top_scores = state.top_scores[:max_top_scores]  # Keep only top N scores
+    top_avg: float = sum(state.top_scores) / len(state.top_scores)
+
+    # Calculate weighted combined average
+    combined_avg: float = (settings["rolling_weight"] * rolling_avg) + (
+        settings["top_weight"] * top_avg
     )
 
-    args = parser.parse_args()
+    # Count tokens in current prefix
+    state.current_token_count = count_tokens(state.adv_prefix)
+    if state.current_token_count < state.min_token_count:
+        state.min_token_count = state.current_token_count
 
-    # Update the global parameters based on command line arguments
-    injection_text = args.injection
-    text = args.mandatory_text
-    init_prefix_words_count = args.init_prefix_words_count
-
-    print(f"Injection text: {injection_text}")
-    print(f"Mandatory text: {text}")
-
-    print(f"\nTrying initial prefix: {init_prefix}")
-
-    # Convert initial adversarial string to tokens
-    best_score: float = float("-inf")
-    best_prefix: Optional[str] = None
-    adv_prefix: str = init_prefix
-    adv_prefix_tokens: torch.Tensor = tokenizer(
-        adv_prefix, return_tensors="pt", add_special_tokens=False
-    )["input_ids"][0]
-    adv_prefix_tokens = adv_prefix_tokens.to(device)  # Move tokens to MPS device
-    control_slice: slice = slice(0, len(adv_prefix_tokens))  # Slice representing the prefix tokens
-
-    best_iteration_score: float = float("-inf")
-    iterations_without_improvement: int = 0
-    found_high_confidence_benign: bool = False
-
-    # Track both rolling and top scores
-    rolling_scores: List[float] = []  # List to store recent scores
-    top_scores: List[float] = []  # List to store top scores
-
-    # Track token counts
-    current_token_count: int = count_tokens(adv_prefix)
-    min_token_count: int = current_token_count
-
-    for i in range(max_iterations):
-        # Prepare input tensors using template
-        full_text = injection_text + adv_prefix + text
-        inputs: Dict[str, torch.Tensor] = tokenizer(full_text, return_tensors="pt")
-        input_ids: torch.Tensor = inputs["input_ids"][0].to(device)  # Move input_ids to MPS device
-
-        # Compute gradients using combined approach
-        coordinate_grad: torch.Tensor = token_gradients_combined(
-            model,
-            input_ids,
-            control_slice,
-            benign_class=benign_class_idx,
-            malicious_class=malicious_class_idx,
-            alpha=alpha,
-            device=device,
+    print(
+        f"Iteration {i+1}{state.label}: Class={model.config.id2label[predicted_class_id]} "
+        + f"(benign: {benign_percentage:.2f}%, loss_norm: {normalized_loss:.4f}, "
+        + f"tokens: {state.current_token_count}, prefix: {state.adv_prefix})"
+    )
+
+    if current_score > state.best_iteration_score:
+        # New best score, reset counter
+        state.best_iteration_score = current_score
+        state.iterations_without_improvement = 0
+    elif current_score >= combined_avg * improvement_threshold:
+        # Score is close enough to combined average, don't count against patience
+        print(
+            f"  Score within {(1-improvement_threshold)*100:.1f}% of combined average, continuing optimization"
+        )
+        # Don't increment iterations_without_improvement
+    else:
+        # Score is significantly worse than combined average, count against patience
+        state.iterations_without_improvement += 1
+        print(
+            f"  No significant improvement for {state.iterations_without_improvement}/{patience} iterations"
         )
 
-        # Ensure coordinate_grad is on the correct device and has the right shape
-        coordinate_grad = coordinate_grad.to(device)
+        # If we're stagnating but not yet at early stopping threshold, try injecting educational text
+        if (
+            state.iterations_without_improvement % stagnation_threshold == 0
+            and state.iterations_without_improvement < patience
+        ):
+            print(f"\n  Optimization stagnating. Looking for words to improve benign rating...")
+
+            # Try to find the best word to add
+            new_prefix: Optional[str]
+            improvement: float
+            with profiler.stage("stagnation_search"):
+                new_prefix, improvement = find_best_word_to_add(
+                    model,
+                    tokenizer,
+                    state.injection_text,
+                    state.adv_prefix,
+                    state.text,
+                    benign_class_idx,
+                    device=device,
+                    num_candidates=len(words),
+                    token_priority=general_token_priority,  # Equal weight to token count and improvement
+                    order_template=settings["order_template"],
+                    baseline_score=benign_score,  # Already known from the candidate batch
+                    batch_size=settings["word_batch_size"],
+                    insert_positions=settings["insert_positions"],
+                    context=state.context,
+                    max_batch_tokens=settings["max_batch_tokens"],
+                    truncation=settings["truncation"],
+                    encoder=state.encoder,
+                )
 
-        # Generate and evaluate new candidates
-        try:
-            # Ensure adv_prefix_tokens is on the correct device
-            adv_prefix_tokens = adv_prefix_tokens.to(device)
+            # The prefix must stay inside the model's input length, or the gradient step would
+            # see it cut off; "flag" only applies to scoring candidates
+            if new_prefix and improvement > 0 and not state.fits(new_prefix):
+                print("  Best word would push the text past the model's input length, skipping it")
+                new_prefix = None
+
+            if new_prefix and improvement > 0:
+                # Use the optimized prefix with the best word added
+                adv_prefix = new_prefix
+                print(f"  Applied optimized prefix with improvement of {improvement:.4f}")
+            else:
+                # Fall back to adding random words if no improvement found
+                random_words: List[str] = get_random_words(
+                    settings["words_to_inject"],
+                    1,
+                    token_priority=general_token_priority,
+                    context=state.context,
+                )
+                # Drop words while the snippet would push the text past the input length
+                while random_words and not state.fits(
+                    " ".join(random_words) + " " + state.adv_prefix
+                ):
+                    random_words.pop()
+                snippet: str = " ".join(random_words)
 
-            # Sample new tokens with exploration parameters
-            new_adv_prefix_toks: torch.Tensor = sample_control(
-                adv_prefix_tokens,
-                coordinate_grad,
-                batch_size=32,  # Larger batch for more candidates
-                topk=16,  # More options per token
-                temp=1.5,  # Higher temperature for more exploration
-            )
+                if snippet:
+                    # Insert the snippet at the beginning
+                    adv_prefix = snippet + " " + state.adv_prefix
+                    print(f"  No improvement found, inserted random words at beginning: '{snippet}'")
+                else:
+                    adv_prefix = state.adv_prefix
+                    print("  No improvement found and no room for more words in the input length")
 
-            # Convert new tokens to text
-            new_adv_prefix: List[str] = get_filtered_cands(
-                tokenizer,
-                new_adv_prefix_toks,
-                filter_cand=False,
-                curr_control=adv_prefix,
+            # Update tokens for next iteration
+            state.set_prefix(adv_prefix)
+
+            # Give the model time to improve with the new text by resetting best score tracking
+            state.best_iteration_score = float("-inf")
+            state.iterations_without_improvement = max(
+                0, state.iterations_without_improvement - grace_period
             )
+            print(f"  Reset optimization tracking to give new text time to work")
+
+    # Early stopping check - only stop if consistently no improvement
+    if state.iterations_without_improvement >= patience:
+        print(f"Early stopping{state.label} after {i+1} iterations with no significant improvement")
+        state.active = False
+        return False
+
+    # Always track the best prefix we've seen, even if not high confidence
+    if (
+        model.config.id2label[predicted_class_id].lower() == benign_class
+        and current_score > state.best_score
+    ):
+        state.best_score = current_score
+        state.best_prefix = state.adv_prefix
+        print(
+            f"New best benign prefix{state.label} found with score: {state.best_score:.4f}, benign confidence: {benign_percentage:.2f}%"
+        )
 
-            # Batch evaluation for all candidates with combined scoring
-            candidate_texts = [injection_text + cand + text for cand in new_adv_prefix]
-            token_counts = [count_tokens(cand) for cand in new_adv_prefix]
-            min_count = min(token_counts) if token_counts else 0
-            max_count = max(token_counts) if token_counts else 1
-            count_range = max(1, max_count - min_count)
-            inputs = tokenizer(candidate_texts, return_tensors="pt", padding=True, truncation=True)
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-
-            with torch.no_grad():
-                logits = model(**inputs).logits
-                probs = torch.softmax(logits, dim=-1)
-                benign_scores = probs[:, benign_class_idx].cpu().numpy()
-                # Compute normalized loss for each candidate
-                losses = nn.CrossEntropyLoss(reduction="none")(
-                    logits,
-                    torch.zeros(logits.shape[0], device=device, dtype=torch.long),
+    # Check if we've found a high confidence benign classification (>95%)
+    if (
+        model.config.id2label[predicted_class_id].lower() == benign_class
+        and benign_score > settings["min_benign_confidence"]
+    ):
+        state.found_high_confidence_benign = True  # Set the flag
+        state.best_score = current_score
+        state.best_prefix = state.adv_prefix
+        print(
+            f"Found high confidence benign classification{state.label} ({benign_percentage:.2f}%) at iteration {i+1}! Stopping optimization."
+        )
+        return True
+
+    return False
+
+
+def search_step(states: List[SearchState]) -> None:
+    """
+    Advance every active trajectory by one iteration. Gradients are computed in one batched
+    forward/backward pass per gradient mode and vocabulary filter (a single pass unless jobs
+    override them) and all candidates are scored in one padded batch. The trajectories may
+    belong to different jobs.
+    """
+    active: List[SearchState] = [state for state in states if state.active]
+
+    # A prefix past the input length would be cut off inside the assembled input, so neither its
+    # gradient nor its candidates could be computed; such trajectories stop
+    for state in active:
+        if not state.encoder.fits(len(state.adv_prefix_tokens)):
+            print(
+                f"  Warning{state.label}: the prefix no longer fits the model's input length, "
+                f"stopping this search"
+            )
+            state.active = False
+    active = [state for state in active if state.active]
+    if not active:
+        return
+
+    # Prepare input tensors by splicing the prefix ids into the cached template ids
+    with profiler.stage("build_inputs"):
+        input_ids_list: List[torch.Tensor] = [
+            torch.tensor(state.input_ids(), dtype=torch.long, device=device) for state in active
+        ]
+
+    # Compute gradients using combined approach, one row of the batch per trajectory. The same
+    # forward pass classifies the current prefixes. Trajectories share a pass when their
+    # gradient mode and vocabulary filter agree, since both apply to the whole pass.
+    vocab_size: int = model.deberta.embeddings.word_embeddings.num_embeddings
+    gradient_groups: Dict[Tuple[str, int, str], List[int]] = {}
+    for idx, state in enumerate(active):
+        filters: Optional[Dict[str, Any]] = state.settings["vocab_filters"]
+        group_key = (
+            state.settings["gradient_mode"],
+            state.settings["vocab_chunk_size"],
+            "" if filters is None else repr(sorted(filters.items())),
+        )
+        gradient_groups.setdefault(group_key, []).append(idx)
+
+    coordinate_grads: List[Optional[torch.Tensor]] = [None] * len(active)
+    logits_rows: List[Optional[torch.Tensor]] = [None] * len(active)
+    for indices in gradient_groups.values():
+        gradient_settings: Dict[str, Any] = active[indices[0]].settings
+        with profiler.stage("vocab_filter"):
+            allowed_tokens: Optional[torch.Tensor] = (
+                token_ids(
+                    tokenizer,
+                    gradient_settings["vocab_filters"],
+                    vocab_size=vocab_size,
+                    device=device,
+                    cache_dir=gradient_settings["vocab_cache_dir"],
                 )
-                normalized_losses = 1.0 / (1.0 + losses.cpu().numpy())
+                if gradient_settings["vocab_filters"] is not None
+                else None
+            )
+        with profiler.stage("gradient"):
+            group_grads, group_logits = token_gradients_batch(
+                model,
+                [input_ids_list[idx] for idx in indices],
+                [active[idx].control_slice for idx in indices],
+                benign_class=benign_class_idx,
+                malicious_class=malicious_class_idx,
+                alpha=[active[idx].settings["alpha"] for idx in indices],
+                device=device,
+                return_logits=True,
+                gradient_mode=gradient_settings["gradient_mode"],
+                vocab_chunk_size=gradient_settings["vocab_chunk_size"],
+                allowed_tokens=allowed_tokens,
+            )
+        for idx, grad, row in zip(indices, group_grads, group_logits):
+            coordinate_grads[idx] = grad
+            logits_rows[idx] = row
+    with profiler.stage("gradient"):
+        current_logits: torch.Tensor = torch.stack(logits_rows)
+        current_probs: torch.Tensor = torch.softmax(current_logits, dim=-1)
+    # The gradient pass classified the current prefixes, so later proposals of them are free
+    score_cache.store([ids.tolist() for ids in input_ids_list], current_logits)
+
+    # Generate new candidates for every trajectory, as (token ids, decoded text) pairs
+    candidate_states: List[SearchState] = []
+    candidate_groups: List[Tuple[List[List[int]], List[str]]] = []
+    for state, coordinate_grad, state_logits, state_probs in zip(
+        active, coordinate_grads, current_logits, current_probs
+    ):
+        state.benign_score = state_probs[benign_class_idx].item()
+
+        # A prefix that did not come from a candidate batch (the initial one or one changed on
+        # stagnation) has not been checked yet; stop right away if it is already good enough
+        if (
+            not state.scored
+            and model.config.id2label[state_logits.argmax().item()].lower() == benign_class
+            and state.benign_score > state.settings["min_benign_confidence"]
+        ):
+            with profiler.stage("update_state"):
+                update_state(state, state_logits, state.iteration)
+            state.iteration += 1
+            continue
 
-            # Compute token penalty for each candidate
-            token_penalties = [
-                1.0 - ((tc - min_count) / count_range) if count_range > 0 else 0
-                for tc in token_counts
-            ]
-            # Compute combined score for each candidate
-            combined_scores = [
-                (alpha * benign_scores[i] + (1 - alpha) * normalized_losses[i])
-                * (1 - token_penalty_weight + token_penalty_weight * token_penalties[i])
-                for i in range(len(new_adv_prefix))
-            ]
-            idx = int(max(range(len(combined_scores)), key=lambda i: combined_scores[i]))
-            adv_prefix = new_adv_prefix[idx]
-
-            # Update the tokens for the next iteration
-            adv_prefix_tokens = tokenizer(
-                adv_prefix, return_tensors="pt", add_special_tokens=False
-            )["input_ids"][0]
-            adv_prefix_tokens = adv_prefix_tokens.to(device)
-
-            # Check the current classification
-            full_text = injection_text + adv_prefix + text
-            inputs: Dict[str, torch.Tensor] = tokenizer(full_text, return_tensors="pt")
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-            with torch.no_grad():
-                logits: torch.Tensor = model(**inputs).logits
-                probs: torch.Tensor = torch.softmax(logits, dim=-1)
-                predicted_class_id: int = logits.argmax().item()
-                benign_score: float = probs[0][benign_class_idx].item()
-                benign_percentage: float = benign_score * 100
-                malicious_score: float = (
-                    probs[0][malicious_class_idx].item() if malicious_class_idx is not None else 0
+        # Sample new tokens with exploration parameters, never from filtered-out tokens
+        with profiler.stage("vocab_filter"):
+            not_allowed: Optional[torch.Tensor] = (
+                token_ids(
+                    tokenizer,
+                    state.settings["vocab_filters"],
+                    allowed=False,
+                    vocab_size=vocab_size,
+                    device=device,
+                    cache_dir=state.settings["vocab_cache_dir"],
                 )
+                if state.settings["vocab_filters"] is not None
+                else None
+            )
+        with profiler.stage("sample_control"):
+            new_adv_prefix_toks: torch.Tensor = sample_control(
+                state.adv_prefix_tokens.to(device),
+                coordinate_grad.to(device),
+                batch_size=state.settings["candidate_batch_size"],
+                topk=state.settings["candidate_topk"],
+                temp=state.settings["candidate_temperature"],
+                not_allowed_tokens=not_allowed,
+                num_coordinates=state.settings["num_coordinates"],
+                positions=state.settings["position_strategy"],
+            )
 
-                # Calculate combined score
-                loss: torch.Tensor = nn.CrossEntropyLoss()(
-                    logits, torch.zeros(logits.shape[0], device=device).long()
+        # Candidates are scored as token ids; the text is only needed for token counts
+        # and the chosen prefix, so decode them all in one call
+        with profiler.stage("decode"):
+            candidate_toks: List[List[int]] = new_adv_prefix_toks.tolist()
+            new_adv_prefix: List[str] = tokenizer.batch_decode(
+                new_adv_prefix_toks, skip_special_tokens=True
+            )
+        if state.settings["filter_candidates"]:
+            with profiler.stage("filter_candidates"):
+                keep: List[bool] = consistent_cands_mask(
+                    tokenizer, candidate_toks, new_adv_prefix, curr_control=state.adv_prefix
                 )
-                normalized_loss: float = 1.0 / (1.0 + loss.item())
-                current_score: float = alpha * benign_score + (1 - alpha) * normalized_loss
-
-                # Update rolling average
-                rolling_scores.append(current_score)
-                if len(rolling_scores) > rolling_window_size:
-                    rolling_scores.pop(0)  # Remove oldest score
-                rolling_avg: float = sum(rolling_scores) / len(rolling_scores)
-
-                # Update top scores
-                top_scores.append(current_score)
-                top_scores.sort(reverse=True)  # Sort in descending order
-                if len(top_scores) > max_top_scores:
-                    top_scores = top_scores[:max_top_scores]  # Keep only top N scores
-                top_avg: float = sum(top_scores) / len(top_scores)
-
-                # Calculate weighted combined average
-                combined_avg: float = (rolling_weight * rolling_avg) + (top_weight * top_avg)
-
-                # Count tokens in current prefix
-                current_token_count = count_tokens(adv_prefix)
-                if current_token_count < min_token_count:
-                    min_token_count = current_token_count
-
+            # Keep the unfiltered batch if no candidate survives
+            if any(keep):
+                candidate_toks = [toks for toks, k in zip(candidate_toks, keep) if k]
+                new_adv_prefix = [cand for cand, k in zip(new_adv_prefix, keep) if k]
+
+        # Candidates that push the payload past the model's input length would be scored on
+        # text the classifier never sees in full
+        fits: List[bool] = [state.encoder.fits(len(toks)) for toks in candidate_toks]
+        if not all(fits):
+            if state.settings["truncation"] == "refuse" and any(fits):
+                candidate_toks = [toks for toks, f in zip(candidate_toks, fits) if f]
+                new_adv_prefix = [cand for cand, f in zip(new_adv_prefix, fits) if f]
+            else:
                 print(
-                    f"Iteration {i+1}: Class={model.config.id2label[predicted_class_id]} "
-                    + f"(benign: {benign_percentage:.2f}%, loss_norm: {normalized_loss:.4f}, "
-                    + f"tokens: {current_token_count}, prefix: {adv_prefix})"
+                    f"  Warning{state.label}: {fits.count(False)} candidates exceed the model's "
+                    f"input length and are evaluated truncated"
                 )
+        candidate_states.append(state)
+        candidate_groups.append((candidate_toks, new_adv_prefix))
+
+    if not candidate_states:
+        return
+
+    # Batch evaluation for all candidates of all trajectories with combined scoring
+    with profiler.stage("build_inputs"):
+        candidate_ids = [
+            state.encoder.build_ids(toks)
+            for state, (candidate_toks, _) in zip(candidate_states, candidate_groups)
+            for toks in candidate_toks
+        ]
+
+    # Candidates classified before are served from the score cache
+    logits: torch.Tensor = classify_ids(
+        model,
+        candidate_ids,
+        tokenizer.pad_token_id,
+        device,
+        cache=score_cache,
+        # Jobs may set different budgets; the smallest one holds for the shared batch
+        max_batch_tokens=min(
+            (
+                state.settings["max_batch_tokens"]
+                for state in candidate_states
+                if state.settings["max_batch_tokens"] is not None
+            ),
+            default=None,
+        ),
+    )
 
-                if current_score > best_iteration_score:
-                    # New best score, reset counter
-                    best_iteration_score = current_score
-                    iterations_without_improvement = 0
-                elif current_score >= combined_avg * improvement_threshold:
-                    # Score is close enough to combined average, don't count against patience
-                    print(
-                        f"  Score within {(1-improvement_threshold)*100:.1f}% of combined average, continuing optimization"
-                    )
-                    # Don't increment iterations_without_improvement
-                else:
-                    # Score is significantly worse than combined average, count against patience
-                    iterations_without_improvement += 1
-                    print(
-                        f"  No significant improvement for {iterations_without_improvement}/{patience} iterations"
-                    )
-
-                    # If we're stagnating but not yet at early stopping threshold, try injecting educational text
-                    if (
-                        iterations_without_improvement % stagnation_threshold == 0
-                        and iterations_without_improvement < patience
-                    ):
-                        print(
-                            f"\n  Optimization stagnating. Looking for words to improve benign rating..."
-                        )
-
-                        # Try to find the best word to add
-                        new_prefix: Optional[str]
-                        improvement: float
-                        new_prefix, improvement = find_best_word_to_add(
-                            model,
-                            tokenizer,
-                            injection_text,
-                            adv_prefix,
-                            text,
-                            benign_class_idx,
-                            device=device,
-                            num_candidates=len(words),
-                            token_priority=general_token_priority,  # Equal weight to token count and improvement
-                        )
-
-                        if new_prefix and improvement > 0:
-                            # Use the optimized prefix with the best word added
-                            adv_prefix = new_prefix
-                            print(
-                                f"  Applied optimized prefix with improvement of {improvement:.4f}"
-                            )
-                        else:
-                            # Fall back to adding random words if no improvement found
-                            snippet: str = " ".join(
-                                get_random_words(
-                                    words_to_inject,
-                                    1,
-                                    token_priority=general_token_priority,
-                                )
-                            )
-
-                            # Insert the snippet at the beginning
-                            adv_prefix = snippet + " " + adv_prefix
-                            print(
-                                f"  No improvement found, inserted random words at beginning: '{snippet}'"
-                            )
-
-                        # Update tokens for next iteration
-                        adv_prefix_tokens = tokenizer(
-                            adv_prefix, return_tensors="pt", add_special_tokens=False
-                        )["input_ids"][0]
-                        adv_prefix_tokens = adv_prefix_tokens.to(device)
-                        control_slice = slice(0, len(adv_prefix_tokens))
-
-                        # Give the model time to improve with the new text by resetting best score tracking
-                        best_iteration_score = float("-inf")
-                        iterations_without_improvement = max(
-                            0, iterations_without_improvement - grace_period
-                        )
-                        print(f"  Reset optimization tracking to give new text time to work")
-
-                # Early stopping check - only stop if consistently no improvement
-                if iterations_without_improvement >= patience:
-                    print(f"Early stopping after {i+1} iterations with no significant improvement")
-                    break
-
-                # Always track the best prefix we've seen, even if not high confidence
-                if (
-                    model.config.id2label[predicted_class_id].lower() == benign_class
-                    and current_score > best_score
-                ):
-                    best_score = current_score
-                    best_prefix = adv_prefix
-                    print(
-                        f"New best benign prefix found with score: {best_score:.4f}, benign confidence: {benign_percentage:.2f}%"
-                    )
-
-                # Check if we've found a high confidence benign classification (>95%)
-                if (
-                    model.config.id2label[predicted_class_id].lower() == benign_class
-                    and benign_score > min_benign_confidence
-                ):
-                    found_high_confidence_benign = True  # Set the flag
-                    best_score = current_score
-                    best_prefix = adv_prefix
-                    print(
-                        f"Found high confidence benign classification ({benign_percentage:.2f}%) at iteration {i+1}! Stopping optimization."
-                    )
-                    break  # Stop optimizing
-
-        except Exception as e:
-            # print stack trace
-            import traceback
-
-            traceback.print_exc()
-            print(f"Error in iteration {i+1}: {str(e)}")
-            continue
+    offset = 0
+    for state, (candidate_toks, new_adv_prefix) in zip(candidate_states, candidate_groups):
+        group_start = offset
+        offset += len(new_adv_prefix)
 
-    # Print final results
-    if found_high_confidence_benign:
-        print(
-            f"\n===== SUCCESS! Found a high confidence benign classification (>{min_benign_confidence*100}%) ====="
-        )
+        with profiler.stage("count_tokens"):
+            token_counts: List[int] = count_tokens_batch(new_adv_prefix)
 
-        # Now minimize the tokens while maintaining the benign classification
-        if best_prefix is not None:
-            best_prefix = minimize_tokens(
-                model,
-                tokenizer,
-                injection_text,
-                best_prefix,
-                text,
+        # Combined score for each candidate, with the token penalty normalized within the trajectory
+        with profiler.stage("scoring"):
+            scores: Dict[str, torch.Tensor] = score_candidates(
+                logits[group_start:offset],
                 benign_class_idx,
-                device=device,
-                min_acceptable_benign=min_acceptable_benign,
+                token_counts,
+                alpha=state.settings["alpha"],
+                token_penalty_weight=state.settings["token_penalty_weight"],
             )
-    else:
-        print("\n===== Did not find a high confidence benign classification =====")
-        if best_prefix is not None:
-            print(f"Best prefix found had a benign score of: {best_score:.4f}")
+            idx = int(scores["combined"].argmax().item())
+
+        # Update the tokens for the next iteration
+        state.set_prefix_tokens(candidate_toks[idx], new_adv_prefix[idx])
+
+        # The batch already classified the chosen candidate, so reuse its logits for the
+        # bookkeeping instead of running the model on it again
+        with profiler.stage("update_state"):
+            update_state(state, logits[group_start + idx], state.iteration)
+        state.iteration += 1
+
+
+# Consecutive failed search steps after which a job is given up on
+MAX_FAILED_STEPS: int = 3
+
+
+class SearchJob:
+    """
+    One search for an (injection, mandatory text) pair, made of one or more trajectories that
+    are optimized side by side. Jobs are advanced with step_jobs, which batches the trajectories
+    of all given jobs together, and turned into a result with finish().
+    """
+
+    def __init__(
+        self,
+        injection_text: str,
+        text: str,
+        settings: Dict[str, Any],
+        name: str = "",
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.start_time: float = time.perf_counter()
+        self.injection_text = injection_text
+        self.text = text
+        self.settings = settings
+        self.name = name
+        self.on_progress = on_progress
+        self.iterations: int = 0
+        self.failed_steps: int = 0  # Consecutive steps that raised for this job
+        self.error: Optional[str] = None  # Set once the job is given up on
+
+        print(f"Injection text: {injection_text}")
+        print(f"Mandatory text: {text}")
+
+        # Word statistics are kept per (model, injection, mandatory text, template)
+        self.context: Optional[str] = (
+            context_key(model_id, injection_text, text, settings["order_template"])
+            if settings["context_stats"]
+            else None
+        )
 
-            # Still try to minimize tokens
-            best_prefix = minimize_tokens(
-                model,
-                tokenizer,
-                injection_text,
-                best_prefix,
-                text,
-                benign_class_idx,
-                device=device,
-                min_acceptable_benign=min_acceptable_benign,
+        self.init_prefix: str = initial_prefix(
+            settings["init_prefix_words_count"], settings["init_token_priority"], self.context
+        )
+        print(f"\nTrying initial prefix: {self.init_prefix}")
+
+        # The fixed template segments are tokenized once and shared by all trajectories
+        self.encoder = PromptEncoder(tokenizer, injection_text, text, settings["order_template"])
+
+        # The first search starts from the database-informed prefix, the others from random words
+        restarts: int = settings["restarts"]
+        self.states: List[SearchState] = []
+        for r in range(restarts):
+            label_parts: List[str] = [name] if name else []
+            if restarts > 1:
+                label_parts.append(f"restart {r+1}/{restarts}")
+            self.states.append(
+                SearchState(
+                    (
+                        self.init_prefix
+                        if r == 0
+                        else restart_prefix(settings["init_prefix_words_count"])
+                    ),
+                    self.encoder,
+                    settings,
+                    label=f" [{' '.join(label_parts)}]" if label_parts else "",
+                    context=self.context,
+                )
+            )
+        if restarts > 1:
+            print(f"Running {restarts} searches side by side")
+
+    @property
+    def done(self) -> bool:
+        """
+        True once a trajectory succeeded, all stopped early, the iteration budget is spent, or
+        the job failed.
+        """
+        return (
+            self.error is not None
+            or any(state.found_high_confidence_benign for state in self.states)
+            or not any(state.active for state in self.states)
+            or self.iterations >= self.settings["max_iterations"]
+        )
+
+    def step_failed(self, error: Exception) -> None:
+        """Count a failed step; the job fails after MAX_FAILED_STEPS failures in a row."""
+        self.failed_steps += 1
+        if self.failed_steps >= MAX_FAILED_STEPS:
+            self.error = f"Search step failed {self.failed_steps} times in a row: {error}"
+            for state in self.states:
+                state.active = False
+
+    def report_progress(self) -> None:
+        """Send one progress event per trajectory to the progress callback, if any."""
+        if self.on_progress is None:
+            return
+        for r, state in enumerate(self.states):
+            self.on_progress(
+                {
+                    "event": "progress",
+                    "iteration": self.iterations,
+                    "restart": r,
+                    "benign_score": state.benign_score,
+                    "tokens": state.current_token_count,
+                    "prefix": state.adv_prefix,
+                }
             )
 
-    # Use the best prefix found across all runs
-    adv_prefix: str = best_prefix if best_prefix is not None else init_prefix
+    def finish(self) -> Dict[str, Any]:
+        """
+        Minimize the best prefix found and classify the final result.
+
+        Returns:
+        --------
+        Dict with the final prefix, its benign score and classification, iteration and token counts
+        """
+        settings: Dict[str, Any] = self.settings
+        injection_text: str = self.injection_text
+        text: str = self.text
+        min_acceptable_benign: float = settings["min_acceptable_benign"]
+        search_seconds: float = time.perf_counter() - self.start_time
+
+        # Pick the best trajectory: a high confidence one if any, otherwise the best score
+        best_state: SearchState = max(
+            self.states, key=lambda state: (state.found_high_confidence_benign, state.best_score)
+        )
+        found_high_confidence_benign: bool = best_state.found_high_confidence_benign
+        best_score: float = best_state.best_score
+        best_prefix: Optional[str] = best_state.best_prefix
+
+        # Print final results
+        if found_high_confidence_benign:
+            print(
+                f"\n===== SUCCESS! Found a high confidence benign classification (>{settings['min_benign_confidence']*100}%) ====="
+            )
+
+            # Now minimize the tokens while maintaining the benign classification
+            if best_prefix is not None:
+                best_prefix = minimize_tokens(
+                    model,
+                    tokenizer,
+                    injection_text,
+                    best_prefix,
+                    text,
+                    benign_class_idx,
+                    device=device,
+                    min_acceptable_benign=min_acceptable_benign,
+                    order_template=settings["order_template"],
+                    batched=settings["batched_minimization"],
+                    encoder=self.encoder,
+                    strategy=settings["minimization_strategy"],
+                    attribution=settings["minimization_attribution"],
+                    attribution_candidates=settings["attribution_candidates"],
+                )
+        else:
+            print("\n===== Did not find a high confidence benign classification =====")
+            if best_prefix is not None:
+                print(f"Best prefix found had a benign score of: {best_score:.4f}")
+
+                # Still try to minimize tokens
+                best_prefix = minimize_tokens(
+                    model,
+                    tokenizer,
+                    injection_text,
+                    best_prefix,
+                    text,
+                    benign_class_idx,
+                    device=device,
+                    min_acceptable_benign=min_acceptable_benign,
+                    order_template=settings["order_template"],
+                    batched=settings["batched_minimization"],
+                    encoder=self.encoder,
+                    strategy=settings["minimization_strategy"],
+                    attribution=settings["minimization_attribution"],
+                    attribution_candidates=settings["attribution_candidates"],
+                )
+
+        # Use the best prefix found across all runs
+        adv_prefix: str = best_prefix if best_prefix is not None else self.init_prefix
+
+        # Classify the final prefix with the template
+        full_text = settings["order_template"].format(
+            injection=injection_text, prefix=adv_prefix, text=text
+        )
+        inputs: Dict[str, torch.Tensor] = tokenizer(full_text, return_tensors="pt")
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        with torch.no_grad():
+            logits: torch.Tensor = model(**inputs).logits
+            probs: torch.Tensor = torch.softmax(logits, dim=-1)
+        predicted_class_id: int = logits.argmax().item()
+        truncated: bool = not self.encoder.fits(len(self.encoder.encode_prefix(adv_prefix)))
+        if truncated:
+            print("Warning: the final text exceeds the model's input length")
+
+        # Cache statistics are process-wide, i.e. shared with other jobs of the process
+        cache_stats: Dict[str, float] = score_cache.stats()
+        print(
+            f"Score cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+            f"({cache_stats['hit_rate'] * 100:.1f}% hit rate, {cache_stats['size']} entries)"
+        )
+
+        return {
+            "prefix": adv_prefix,
+            "full_text": full_text,
+            # Everything except the payload, i.e. what has to be combined with it
+            "template_text": settings["order_template"].format(
+                injection=injection_text, prefix=adv_prefix, text=""
+            ),
+            "benign_score": probs[0][benign_class_idx].item(),
+            "predicted_class": model.config.id2label[predicted_class_id],
+            "found_high_confidence_benign": found_high_confidence_benign,
+            # Whether the classifier only saw the final text truncated
+            "truncated": truncated,
+            "iterations": self.iterations,
+            "prefix_tokens": count_tokens(adv_prefix),
+            "total_tokens": count_tokens(full_text),
+            "search_seconds": search_seconds,
+            "seconds": time.perf_counter() - self.start_time,
+        }
+
+
+def step_jobs(jobs: List[SearchJob]) -> None:
+    """
+    Advance all trajectories of the given jobs by one iteration in shared batches. If the shared
+    step fails, each job is stepped on its own, so a failing job cannot hold back the others.
+    """
+    for job in jobs:
+        job.iterations += 1
+
+    profiler.step()
+    failures: Dict[SearchJob, Exception] = {}
+    try:
+        with profiler.stage("iteration"):
+            search_step([state for job in jobs for state in job.states if state.active])
+    except Exception as e:
+        # print stack trace
+        traceback.print_exc()
+        print(f"Error in search step: {str(e)}")
+        if len(jobs) == 1:
+            failures[jobs[0]] = e
+        else:
+            for job in jobs:
+                try:
+                    with profiler.stage("iteration"):
+                        search_step([state for state in job.states if state.active])
+                except Exception as job_error:
+                    traceback.print_exc()
+                    print(f"Error in search step of job '{job.name}': {str(job_error)}")
+                    failures[job] = job_error
+
+    for job in jobs:
+        if job in failures:
+            job.step_failed(failures[job])
+        else:
+            job.failed_steps = 0
+        job.report_progress()
+
+
+def optimize(
+    injection_text: str,
+    text: str,
+    settings: Dict[str, Any],
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Run the full search for one (injection, mandatory text) pair with the resident model:
+    batched restarts, token minimization and a final classification of the result.
+
+    Parameters:
+    -----------
+    injection_text: The injection text that precedes the prefix
+    text: The mandatory text that follows the prefix
+    settings: Search parameters as returned by load_settings
+    on_progress: Optional callback receiving one event dict per trajectory per iteration
+
+    Returns:
+    --------
+    Dict with the final prefix, its benign score and classification, iteration and token counts
+
+    Raises:
+    -------
+    RuntimeError: If the search steps keep failing (see MAX_FAILED_STEPS)
+    """
+    job = SearchJob(injection_text, text, settings, on_progress=on_progress)
+    while not job.done:
+        step_jobs([job])
+    if job.error is not None:
+        raise RuntimeError(job.error)
+    return job.finish()
+
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Prompt hacking tool")
+    parser.add_argument(
+        "--injection",
+        type=str,
+        default=text_config["injection"],
+        help="Injection text to use in the template",
+    )
+    parser.add_argument(
+        "--mandatory-text",
+        type=str,
+        default=text_config["mandatory"],
+        help="Mandatory text to use in the template",
+    )
+    parser.add_argument(
+        "--init-prefix-words-count",
+        type=int,
+        default=prefix_config["init_words_count"],
+        help="Number of words to use in the initial prefix",
+    )
+    parser.add_argument(
+        "--order-template",
+        type=str,
+        default=text_config.get("order_template", "{injection}{prefix}{text}"),
+        help="Order of the components, using {injection}, {prefix} and {text}",
+    )
+    parser.add_argument(
+        "--restarts",
+        type=int,
+        default=optimization_config.get("restarts", 1),
+        help="Number of independent searches to optimize side by side in one batch",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time every search stage and print a summary at the end",
+    )
+    parser.add_argument(
+        "--profile-trace",
+        type=str,
+        default="profile_trace.json",
+        help="Chrome trace JSON written when profiling",
+    )
+
+    args = parser.parse_args()
+    if args.profile:
+        profiler.enable(device)
+
+    # Override the configuration with the command line arguments
+    settings: Dict[str, Any] = load_settings(
+        {
+            "prefix": {"init_words_count": args.init_prefix_words_count},
+            "optimization": {"restarts": args.restarts},
+            "text": {"order_template": args.order_template},
+        }
+    )
+    injection_text: str = args.injection
+    text: str = args.mandatory_text
+
+    result: Dict[str, Any] = optimize(injection_text, text, settings)
+    adv_prefix: str = result["prefix"]
+    full_text: str = result["full_text"]
 
     # Without adversarial prefix
     inputs: Dict[str, torch.Tensor] = tokenizer(text, return_tensors="pt")
@@ -479,25 +1111,19 @@ def main():
     )
 
     # With adversarial prefix
-    full_text = injection_text + adv_prefix + text
-    inputs = tokenizer(full_text, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}  # Move inputs to MPS device
-    logits = model(**inputs).logits
-    probs = torch.softmax(logits, dim=-1)
-    predicted_class_id = logits.argmax().item()
-    benign_prob = probs[0][benign_class_idx].item() * 100
     print(f"Prefix is: {adv_prefix}")
     print(f"Complete text using template is: {full_text}")
-    print(f"COPY THIS:\n --- \n{injection_text+adv_prefix}\n --- \n")
+    print(f"COPY THIS:\n --- \n{result['template_text']}\n --- \n")
     print(
-        f"Payload with prefix is classified as: {model.config.id2label[predicted_class_id]} (benign probability: {benign_prob:.2f}%)"
+        f"Payload with prefix is classified as: {result['predicted_class']} (benign probability: {result['benign_score'] * 100:.2f}%)"
     )
 
-    # Try to run inference with the model's classifier
+    # Try to run inference with the model's classifier, reusing the already loaded model
     classifier = pipeline(
         "text-classification",
-        model=model_id,
-        device=0 if cuda_available else -1,
+        model=model,
+        tokenizer=tokenizer,
+        device=device,
     )
 
     try:
@@ -511,8 +1137,13 @@ def main():
     except Exception as e:
         print(f"Error running classifier pipeline: {str(e)}")
 
-    print(f"Adv prefix token count: {count_tokens(adv_prefix)}")
-    print(f"Total token count: {count_tokens(full_text)}")
+    print(f"Adv prefix token count: {result['prefix_tokens']}")
+    print(f"Total token count: {result['total_tokens']}")
+
+    if args.profile:
+        print(f"\n{profiler.summary()}")
+        profiler.write_trace(args.profile_trace)
+        print(f"Chrome trace written to {args.profile_trace}")
 
 
 if __name__ == "__main__":
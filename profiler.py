@@ -0,0 +1,99 @@
+import json
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import torch
+
+
+class Profiler:
+    """
+    Optional wall-clock and device timing of the search stages.
+
+    Stages are timed with `with profiler.stage("name"):`. While disabled a stage costs one
+    context manager call. While enabled on CUDA, every stage records CUDA events and waits for
+    the device at its end, so its wall time includes the device work it queued and its device
+    time is reported separately. Stages may be nested (e.g. "forward" inside
+    "stagnation_search"), so their totals can add up to more than the run time.
+    """
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.use_cuda: bool = False
+        self.iteration: int = 0
+        self.start_time: float = 0.0
+        self.events: List[Dict[str, Any]] = []  # Chrome trace events
+        self.totals: Dict[str, List[float]] = {}  # name -> [calls, wall seconds, device seconds]
+
+    def enable(self, device: Optional[torch.device] = None) -> None:
+        """Start recording; device time is measured when the device is a CUDA device."""
+        self.enabled = True
+        self.use_cuda = device is not None and torch.device(device).type == "cuda"
+        self.start_time = time.perf_counter()
+
+    def step(self) -> None:
+        """Mark the start of the next search iteration."""
+        self.iteration += 1
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as one call of the given stage."""
+        if not self.enabled:
+            yield
+            return
+
+        if self.use_cuda:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            device_seconds: float = 0.0
+            if self.use_cuda:
+                end_event.record()
+                end_event.synchronize()
+                device_seconds = start_event.elapsed_time(end_event) / 1000
+            end: float = time.perf_counter()
+
+            totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += end - start
+            totals[2] += device_seconds
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.start_time) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": {"iteration": self.iteration, "device_ms": device_seconds * 1000},
+                }
+            )
+
+    def summary(self) -> str:
+        """Table of calls, total and mean wall time, device time and share of the run per stage."""
+        run_seconds: float = max(time.perf_counter() - self.start_time, 1e-9)
+        lines: List[str] = [
+            f"Profile of {self.iteration} iterations over {run_seconds:.2f}s",
+            f"{'stage':<20} {'calls':>7} {'total s':>9} {'mean ms':>9} {'device s':>9} {'% run':>6}",
+        ]
+        for name, (calls, wall, device_seconds) in sorted(
+            self.totals.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            lines.append(
+                f"{name:<20} {int(calls):>7} {wall:>9.3f} {wall / calls * 1000:>9.2f} "
+                f"{device_seconds:>9.3f} {wall / run_seconds * 100:>6.1f}"
+            )
+        return "\n".join(lines)
+
+    def write_trace(self, path: str) -> None:
+        """Write the recorded stages as Chrome trace JSON (chrome://tracing or Perfetto)."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+# Process-wide profiler used by the search, disabled unless --profile is given
+profiler = Profiler()
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class ScoreCache:
+    """
+    Bounded LRU cache of classifier logits keyed by the full input id sequence.
+
+    The search often proposes sequences it has already classified (after stagnation resets,
+    across restarts and during minimization), so classify_ids looks every sequence up here
+    first and only runs the model on the misses. Keys are complete assembled sequences, so
+    entries of different injection/payload pairs never collide.
+    """
+
+    def __init__(self, max_size: int = 20000):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def configure(self, max_size: Optional[int] = None) -> None:
+        """Change the capacity (0 disables the cache)."""
+        if max_size is not None:
+            self.max_size = max(0, int(max_size))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def lookup(self, ids_list: Sequence[Sequence[int]]) -> Tuple[Dict[int, torch.Tensor], List[int]]:
+        """
+        Split sequences into cached and missing ones.
+
+        Returns:
+        --------
+        cached: Logits of the cached sequences, by position in ids_list
+        missing: Positions in ids_list that have to be classified
+        """
+        cached: Dict[int, torch.Tensor] = {}
+        missing: List[int] = []
+        for idx, ids in enumerate(ids_list):
+            key = tuple(ids)
+            logits: Optional[torch.Tensor] = self._entries.get(key)
+            if logits is None:
+                missing.append(idx)
+            else:
+                self._entries.move_to_end(key)
+                cached[idx] = logits
+        self.hits += len(cached)
+        self.misses += len(missing)
+        return cached, missing
+
+    def store(self, ids_list: Sequence[Sequence[int]], logits: torch.Tensor) -> None:
+        """Remember the logits (one row per sequence) of classified sequences."""
+        if self.max_size <= 0:
+            return
+        for ids, row in zip(ids_list, logits.detach()):
+            key = tuple(ids)
+            self._entries[key] = row
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        """Hits, misses, hit rate and current size."""
+        lookups: int = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+        }
+
+
+# Process-wide cache shared by the candidate batch, the stagnation search and minimization
+score_cache = ScoreCache()
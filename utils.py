@@ -1,11 +1,16 @@
+import functools
 import torch
+from collections import OrderedDict
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, List, Optional, Sequence, Tuple, Any, Union
 import tiktoken
 import random
 import torch.nn as nn
 from words import words4 as words
 from wordsdb import WordsDatabase
+from encoder import PromptEncoder, pad_batch
+from profiler import profiler
+from score_cache import ScoreCache, score_cache
 
 # Create a global instance of the database
 words_db = WordsDatabase()
@@ -24,11 +29,21 @@ def find_best_word_to_add(
     use_db: bool = True,  # Whether to use the database for word selection and tracking
     token_priority: float = 0.3,  # How much to prioritize words with fewer tokens when selecting from database
     order_template: str = "{injection}{prefix}{text}",  # Template for ordering components
+    baseline_score: Optional[float] = None,  # Benign score of the current prefix, if already known
+    batch_size: Union[int, str, None] = "auto",  # Candidates per forward pass ("auto" sizes from free memory)
+    insert_positions: str = "fixed",  # "fixed" (beginning/middle/end) or "all" word boundaries
+    context: Optional[str] = None,  # Search context the word statistics are kept for
+    max_batch_tokens: Optional[int] = None,  # Padded tokens per forward pass (None = no limit)
+    truncation: str = "refuse",  # "refuse" or "flag" candidates longer than the model accepts
+    encoder: Optional[PromptEncoder] = None,  # Token-level template shared with the main loop
 ) -> Tuple[Optional[str], float]:
     """
     Evaluate multiple candidate words and find the one that most improves the benign score when added to the prefix.
     Prioritizes words that result in fewer tokens while still improving the benign score.
 
+    Candidates are assembled with the PromptEncoder like the main loop's candidates, so their
+    scores are comparable with a baseline_score taken from the candidate batch.
+
     Parameters:
     -----------
     model: The model to evaluate with
@@ -42,6 +57,16 @@ def find_best_word_to_add(
     use_db: Whether to use the database for word selection and tracking
     token_priority: How much to prioritize words with fewer tokens when selecting from database
     order_template: Template string for ordering components (using {injection}, {prefix}, {text})
+    baseline_score: Benign score of the current prefix; computed with an extra forward pass if not given
+    batch_size: Maximum candidates per forward pass; "auto" sizes it from free device memory and None
+                evaluates everything in one pass. Batches are halved on out-of-memory errors
+    insert_positions: "fixed" tries the beginning, middle and end of the prefix; "all" tries every
+                      word boundary
+    context: Search context (see wordsdb.context_key) used to rank and record words in the database
+    max_batch_tokens: Maximum padded tokens per forward pass; candidates are grouped by length
+    truncation: What to do with candidates whose text the model would see truncated: "refuse"
+                leaves them out, "flag" evaluates the truncated text and reports how many there are
+    encoder: PromptEncoder of the search; built from the texts and order_template if not given
 
     Returns:
     --------
@@ -50,31 +75,38 @@ def find_best_word_to_add(
     """
     print(f"\n----- TESTING {num_candidates} CANDIDATE WORDS TO ADD (BATCHED) -----")
 
+    if encoder is None:
+        encoder = PromptEncoder(tokenizer, injection_text, text, order_template)
+
     # Get baseline benign score with current prefix
-    try:
-        full_text = order_template.format(injection=injection_text, prefix=adv_prefix, text=text)
-        inputs: Dict[str, torch.Tensor] = tokenizer(full_text, return_tensors="pt")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        with torch.no_grad():
-            logits: torch.Tensor = model(**inputs).logits
-            probs: torch.Tensor = torch.softmax(logits, dim=-1)
-            baseline_score: float = probs[0][benign_class_idx].item()
-        print(f"Baseline benign score: {baseline_score:.4f}")
-    except Exception as e:
-        print(f"Error testing baseline: {e}")
-        return None, 0
+    if baseline_score is None:
+        try:
+            logits: torch.Tensor = classify_ids(
+                model,
+                [encoder.build_ids(encoder.encode_prefix(adv_prefix))],
+                tokenizer.pad_token_id,
+                device,
+                cache=score_cache,
+            )
+            baseline_score = torch.softmax(logits, dim=-1)[0][benign_class_idx].item()
+        except Exception as e:
+            print(f"Error testing baseline: {e}")
+            return None, 0
+    print(f"Baseline benign score: {baseline_score:.4f}")
 
     # Generate candidate words to test - prioritize known good words if using database
     if use_db:
         # Try to get high-performing words from the database, with token count consideration
         db_candidates_count = num_candidates // 2
         if db_candidates_count > 0:
-            top_words = words_db.get_top_words(
-                limit=db_candidates_count,
-                min_uses=1,  # Only need to have been tested once
-                sort_by="combined" if token_priority > 0 else "improvement",
-                token_weight=token_priority,
-            )
+            with profiler.stage("db_read"):
+                top_words = words_db.get_top_words(
+                    limit=db_candidates_count,
+                    min_uses=1,  # Only need to have been tested once
+                    sort_by="combined" if token_priority > 0 else "improvement",
+                    token_weight=token_priority,
+                    context=context,
+                )
 
             # If we got some words from the database, use them plus some random words
             if top_words:
@@ -92,88 +124,102 @@ def find_best_word_to_add(
         # Just use random words if not using the database
         candidates = random.choices(words, k=num_candidates)
 
-    # Define positions to test for each word
-    insert_positions: List[str] = ["beginning", "middle", "end"]
-
     # Generate all candidate prefixes - one for each word + position combination
     all_candidate_prefixes = []
+    seen_prefixes: set = set()
     for word in candidates:
-        for position in insert_positions:
-            # Create test prefix with the candidate word
-            if position == "beginning":
-                test_prefix: str = word + " " + adv_prefix
-            elif position == "end":
-                test_prefix = adv_prefix + " " + word
-            else:  # middle
-                # Find a reasonable spot to insert in the middle if possible
-                if " " in adv_prefix:
-                    words_list: List[str] = adv_prefix.split()
-                    middle_idx: int = len(words_list) // 2
-                    words_list.insert(middle_idx, word)
-                    test_prefix = " ".join(words_list)
-                else:
-                    # If no spaces, insert at midpoint of string
-                    middle_idx: int = len(adv_prefix) // 2
-                    test_prefix = (
-                        adv_prefix[:middle_idx] + " " + word + " " + adv_prefix[middle_idx:]
-                    )
-
+        for position, test_prefix in insertion_prefixes(adv_prefix, word, insert_positions):
+            # Duplicate words (and positions that coincide) only need one evaluation
+            if test_prefix in seen_prefixes:
+                continue
+            seen_prefixes.add(test_prefix)
             all_candidate_prefixes.append(
-                {
-                    "prefix": test_prefix,
-                    "word": word,
-                    "position": position,
-                    "token_count": len(tokenizer.encode(test_prefix, add_special_tokens=False)),
-                }
+                {"prefix": test_prefix, "word": word, "position": position}
             )
 
-    # Prepare all candidate full texts for batch evaluation
-    candidate_full_texts = [
-        order_template.format(injection=injection_text, prefix=c["prefix"], text=text)
-        for c in all_candidate_prefixes
-    ]
+    # Assemble the candidates in token space, exactly like the main loop's candidate batch
+    with profiler.stage("tokenize"):
+        candidate_prefix_ids: List[List[int]] = [
+            encoder.encode_prefix(c["prefix"]) for c in all_candidate_prefixes
+        ]
+        for c, prefix_ids in zip(all_candidate_prefixes, candidate_prefix_ids):
+            c["token_count"] = len(prefix_ids)
+        candidate_ids: List[List[int]] = [
+            encoder.build_ids(prefix_ids) for prefix_ids in candidate_prefix_ids
+        ]
+        # Candidates the model would only see truncated are refused or flagged
+        truncated: List[bool] = [
+            not encoder.fits(len(prefix_ids)) for prefix_ids in candidate_prefix_ids
+        ]
+    if any(truncated):
+        if truncation == "refuse":
+            print(f"Refusing {sum(truncated)} candidate prefixes that exceed the model's input length")
+            all_candidate_prefixes = [
+                c for c, cut in zip(all_candidate_prefixes, truncated) if not cut
+            ]
+            candidate_ids = [ids for ids, cut in zip(candidate_ids, truncated) if not cut]
+        else:
+            print(
+                f"Warning: {sum(truncated)} candidate prefixes exceed the model's input length "
+                f"and are evaluated truncated"
+            )
 
-    if not candidate_full_texts:
+    if not candidate_ids:
         print("No candidate prefixes to evaluate")
         return None, 0
 
-    # Batch inference
+    # Batch inference in memory-bounded chunks of similar lengths
+    if batch_size == "auto":
+        batch_size = auto_batch_size(model, max(len(ids) for ids in candidate_ids), device)
+    batch_size = int(batch_size or len(candidate_ids))
+    print(f"Evaluating {len(candidate_ids)} candidate prefixes in batches of up to {batch_size}")
     try:
-        inputs = tokenizer(candidate_full_texts, return_tensors="pt", padding=True, truncation=True)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        with torch.no_grad():
-            logits = model(**inputs).logits
-            probs = torch.softmax(logits, dim=-1)
-            benign_scores = probs[:, benign_class_idx].cpu().numpy()
+        logits = classify_ids(
+            model,
+            candidate_ids,
+            tokenizer.pad_token_id,
+            device,
+            batch_size,
+            cache=score_cache,
+            max_batch_tokens=max_batch_tokens,
+        )
     except Exception as e:
         print(f"Error in batch evaluation: {e}")
         return None, 0
 
-    # Calculate token counts for normalization
+    # Token efficiency is the token count normalized to 0-1 (where 1 is better = fewer tokens)
     token_counts = [c["token_count"] for c in all_candidate_prefixes]
-    max_token_count = max(token_counts) if token_counts else 1
+    scores = score_candidates(logits, benign_class_idx, token_counts, relative_to_min=False)
+    improvements_t: torch.Tensor = scores["benign"] - baseline_score
+
+    # Calculate combined score (weighting improvement and token efficiency)
+    # Only consider token efficiency if improvement is positive
+    combined_t: torch.Tensor = torch.where(
+        improvements_t > 0,
+        (1 - token_weight) * improvements_t + token_weight * scores["token_penalty"],
+        torch.zeros_like(improvements_t),
+    )
+
+    # Only consider improvements (benign_score > baseline_score)
+    best_result_idx = int(combined_t.argmax().item())
+    if combined_t[best_result_idx].item() <= 0:
+        best_result_idx = -1
 
     # Process the results
     results = []
-    best_combined_score = 0
-    best_result_idx = -1
+    benign_scores: List[float] = scores["benign"].tolist()
+    improvements: List[float] = improvements_t.tolist()
+    token_efficiencies: List[float] = scores["token_penalty"].tolist()
+    combined_scores: List[float] = combined_t.tolist()
 
     print(f"Running score analysis for {len(all_candidate_prefixes)} candidate prefixes")
 
     for idx, candidate in enumerate(all_candidate_prefixes):
         benign_score = benign_scores[idx]
-        improvement = benign_score - baseline_score
+        improvement = improvements[idx]
         token_count = candidate["token_count"]
-
-        # Calculate token efficiency (lower token count is better)
-        # Normalize token count to 0-1 scale (where 1 is better = fewer tokens)
-        token_efficiency = 1.0 - min(1.0, token_count / max_token_count)
-
-        # Calculate combined score (weighting improvement and token efficiency)
-        # Only consider token efficiency if improvement is positive
-        combined_score = 0
-        if improvement > 0:
-            combined_score = (1 - token_weight) * improvement + token_weight * token_efficiency
+        token_efficiency = token_efficiencies[idx]
+        combined_score = combined_scores[idx]
 
         # Record performance in results list
         result = {
@@ -191,22 +237,19 @@ def find_best_word_to_add(
 
         # Record the performance in the database if enabled
         if use_db and improvement != 0:  # Only record non-zero improvements
-            words_db.record_word_performance(
-                candidate["word"],
-                candidate["position"],
-                benign_score,
-                improvement,
-                token_count,
-                combined_score,
-            )
+            with profiler.stage("db_write"):
+                words_db.record_word_performance(
+                    candidate["word"],
+                    candidate["position"],
+                    benign_score,
+                    improvement,
+                    token_count,
+                    combined_score,
+                    context=context,
+                )
 
         # print(f"Word '{candidate['word']}' at {candidate['position']}: {benign_score:.4f} (Δ: {improvement:.4f}, tokens: {token_count}, combined: {combined_score:.4f})")
 
-        # Only consider improvements (benign_score > baseline_score)
-        if improvement > 0 and combined_score > best_combined_score:
-            best_combined_score = combined_score
-            best_result_idx = idx
-
     # Sort results by combined score
     results.sort(key=lambda x: x["combined_score"], reverse=True)
 
@@ -235,6 +278,97 @@ def find_best_word_to_add(
         return None, 0
 
 
+def insertion_prefixes(adv_prefix: str, word: str, insert_positions: str = "fixed") -> List[Tuple[str, str]]:
+    """
+    Build the prefixes obtained by inserting a word into the current prefix.
+
+    Parameters:
+    -----------
+    adv_prefix: The current prefix
+    word: The word to insert
+    insert_positions: "fixed" for the beginning, middle and end of the prefix, "all" for every
+                      word boundary
+
+    Returns:
+    --------
+    List of (position label, new prefix) pairs
+    """
+    if insert_positions == "all":
+        words_list: List[str] = adv_prefix.split()
+        prefixes: List[Tuple[str, str]] = []
+        for idx in range(len(words_list) + 1):
+            if idx == 0:
+                position = "beginning"
+            elif idx == len(words_list):
+                position = "end"
+            else:
+                position = f"word {idx}"
+            prefixes.append((position, " ".join(words_list[:idx] + [word] + words_list[idx:])))
+        return prefixes
+    if insert_positions != "fixed":
+        raise ValueError(f"Unknown insert_positions: {insert_positions}")
+
+    # Find a reasonable spot to insert in the middle if possible
+    if " " in adv_prefix:
+        words_list = adv_prefix.split()
+        middle_idx: int = len(words_list) // 2
+        words_list.insert(middle_idx, word)
+        middle_prefix: str = " ".join(words_list)
+    else:
+        # If no spaces, insert at midpoint of string
+        middle_idx = len(adv_prefix) // 2
+        middle_prefix = adv_prefix[:middle_idx] + " " + word + " " + adv_prefix[middle_idx:]
+    return [
+        ("beginning", word + " " + adv_prefix),
+        ("middle", middle_prefix),
+        ("end", adv_prefix + " " + word),
+    ]
+
+
+def auto_batch_size(
+    model: AutoModelForSequenceClassification,
+    seq_len: int,
+    device: torch.device,
+    memory_fraction: float = 0.5,
+    default: int = 64,
+    max_batch_size: int = 1024,
+) -> int:
+    """
+    Estimate how many sequences of seq_len tokens fit in one inference pass.
+
+    Uses the free memory reported by CUDA and a rough per-sequence activation footprint (hidden
+    states and attention scores of one layer, since no activations are kept without gradients).
+    Other devices use `default`.
+
+    Parameters:
+    -----------
+    model: The model to evaluate with
+    seq_len: Length of the longest sequence in the batch
+    memory_fraction: Fraction of the free memory the batch may use
+    default: Batch size used when free memory cannot be queried
+    max_batch_size: Upper bound on the returned batch size
+    """
+    device = torch.device(device)
+    if device.type != "cuda" or not torch.cuda.is_available():
+        return default
+    try:
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+    except Exception:
+        return default
+
+    model_config = model.config
+    hidden: int = getattr(model_config, "hidden_size", 768)
+    heads: int = getattr(model_config, "num_attention_heads", 12)
+    intermediate: int = getattr(model_config, "intermediate_size", 4 * hidden)
+    dtype_bytes: int = next(model.parameters()).element_size()
+
+    # Hidden states, feed-forward activations and (disentangled) attention score matrices
+    per_sequence: int = (
+        seq_len * (6 * hidden + 2 * intermediate) + 3 * heads * seq_len * seq_len
+    ) * dtype_bytes
+    return int(max(1, min(max_batch_size, free_bytes * memory_fraction // max(1, per_sequence))))
+
+
 def token_gradients_combined(
     model: AutoModelForSequenceClassification,
     input_ids: torch.Tensor,
@@ -267,48 +401,380 @@ def token_gradients_combined(
     torch.Tensor
         The combined gradients for token optimization.
     """
-
-    embed_weights: torch.Tensor = model.deberta.embeddings.word_embeddings.weight
-    one_hot: torch.Tensor = torch.zeros(
-        input_ids[input_slice].shape[0],
-        embed_weights.shape[0],
+    return token_gradients_batch(
+        model,
+        [input_ids],
+        [input_slice],
         device=device,
-        dtype=embed_weights.dtype,
-    )
-    one_hot.scatter_(
-        1,
-        input_ids[input_slice].unsqueeze(1),
-        torch.ones(one_hot.shape[0], 1, device=device, dtype=embed_weights.dtype),
-    )
-    one_hot.requires_grad_()
-    input_embeds: torch.Tensor = (one_hot @ embed_weights).unsqueeze(0)
+        benign_class=benign_class,
+        malicious_class=malicious_class,
+        alpha=alpha,
+    )[0]
 
-    # now stitch it together with the rest of the embeddings
-    embeds: torch.Tensor = model.deberta.embeddings.word_embeddings(input_ids)
-    full_embeds: torch.Tensor = torch.cat(
-        [
-            embeds[: input_slice.start, :],
-            input_embeds.squeeze(),
-            embeds[input_slice.stop :, :],
-        ],
-        dim=0,
+
+def token_gradients_batch(
+    model: AutoModelForSequenceClassification,
+    input_ids_list: List[torch.Tensor],
+    input_slices: List[slice],
+    device: torch.device,
+    benign_class: int = 1,
+    malicious_class: int = 0,
+    alpha: Union[float, Sequence[float]] = 0.5,
+    return_logits: bool = False,
+    gradient_mode: str = "one_hot",
+    vocab_chunk_size: int = 8192,
+    allowed_tokens: Optional[torch.Tensor] = None,
+) -> Union[List[torch.Tensor], Tuple[List[torch.Tensor], torch.Tensor]]:
+    """
+    Batched version of token_gradients_combined: computes the combined gradients for several
+    independent sequences with a single padded forward/backward pass.
+
+    The per-sequence losses are summed rather than averaged, so each returned gradient is
+    identical to the one token_gradients_combined would compute for that sequence alone.
+
+    Parameters
+    ----------
+    model : Transformer Model
+        The transformer model to be used.
+    input_ids_list : list of torch.Tensor
+        One 1-D sequence of token ids per search; lengths may differ.
+    input_slices : list of slice
+        For each sequence, the slice of tokens for which gradients need to be computed.
+    benign_class : int
+        The benign class index to optimize for.
+    malicious_class : int
+        The malicious class index to minimize.
+    alpha : float or sequence of float
+        Weight for the benign optimization (1-alpha is weight for loss minimization),
+        either shared or one value per sequence
+    return_logits : bool
+        Also return the logits of the forward pass, i.e. the classification of the
+        unmodified sequences, so callers need no separate forward pass for them.
+    gradient_mode : str
+        "one_hot" differentiates through a one-hot (slice length x vocab size) matrix times the
+        embedding matrix. "embedding" differentiates with respect to the prefix embeddings only
+        and projects that gradient onto the vocabulary with project_gradients, which gives the
+        same values without the one-hot matrix, its gradient or a gradient for the embedding
+        matrix.
+    vocab_chunk_size : int
+        Vocabulary rows projected per matmul in "embedding" mode.
+    allowed_tokens : torch.Tensor, optional
+        In "embedding" mode, only project onto these token ids; the others get +inf, which
+        sample_control never picks.
+
+    Returns
+    -------
+    list of torch.Tensor
+        The combined gradients for each sequence, shaped (slice length, vocab size).
+    torch.Tensor
+        Only if return_logits: the detached logits, shaped (number of sequences, classes).
+    """
+    if gradient_mode not in ("one_hot", "embedding"):
+        raise ValueError(f"Unknown gradient mode: {gradient_mode}")
+    embed_layer = model.deberta.embeddings.word_embeddings
+    embed_weights: torch.Tensor = embed_layer.weight
+
+    one_hots: List[torch.Tensor] = []
+    control_embeds: List[torch.Tensor] = []
+    rows: List[torch.Tensor] = []
+    for input_ids, input_slice in zip(input_ids_list, input_slices):
+        input_ids = input_ids.to(device)
+        if input_slice.stop > input_ids.shape[0]:
+            raise ValueError(
+                f"Control slice {input_slice} exceeds the input length {input_ids.shape[0]}"
+            )
+        if gradient_mode == "embedding":
+            # Leaf tensor for the prefix embeddings; nothing else needs a gradient
+            with torch.no_grad():
+                embeds = embed_layer(input_ids)
+            control: torch.Tensor = embeds[input_slice].clone().requires_grad_()
+            control_embeds.append(control)
+            rows.append(
+                torch.cat([embeds[: input_slice.start], control, embeds[input_slice.stop :]], dim=0)
+            )
+            continue
+
+        one_hot: torch.Tensor = torch.zeros(
+            input_ids[input_slice].shape[0],
+            embed_weights.shape[0],
+            device=device,
+            dtype=embed_weights.dtype,
+        )
+        one_hot.scatter_(
+            1,
+            input_ids[input_slice].unsqueeze(1),
+            torch.ones(one_hot.shape[0], 1, device=device, dtype=embed_weights.dtype),
+        )
+        one_hot.requires_grad_()
+        one_hots.append(one_hot)
+
+        # now stitch it together with the rest of the embeddings
+        embeds: torch.Tensor = embed_layer(input_ids)
+        rows.append(
+            torch.cat(
+                [
+                    embeds[: input_slice.start, :],
+                    one_hot @ embed_weights,
+                    embeds[input_slice.stop :, :],
+                ],
+                dim=0,
+            )
+        )
+
+    # Right-pad to a common length; padded positions are masked out of attention
+    full_embeds: torch.Tensor = nn.utils.rnn.pad_sequence(rows, batch_first=True)
+    attention_mask: torch.Tensor = torch.zeros(
+        full_embeds.shape[:2], device=device, dtype=torch.long
     )
-    logits: torch.Tensor = model(inputs_embeds=full_embeds.unsqueeze(0)).logits
+    for row_idx, row in enumerate(rows):
+        attention_mask[row_idx, : row.shape[0]] = 1
+
+    logits: torch.Tensor = model(inputs_embeds=full_embeds, attention_mask=attention_mask).logits
 
     # Combined loss: minimize malicious class (standard loss) and maximize benign class
-    standard_loss: torch.Tensor = nn.CrossEntropyLoss()(
+    standard_loss: torch.Tensor = nn.CrossEntropyLoss(reduction="none")(
         logits, torch.zeros(logits.shape[0], device=device).long()
     )
 
     # Maximize benign class probability
     log_probs: torch.Tensor = torch.log_softmax(logits, dim=1)
-    benign_loss: torch.Tensor = -log_probs[0, benign_class]
+    benign_loss: torch.Tensor = -log_probs[:, benign_class]
+
+    # Combined loss with weighting, summed so the sequences do not dilute each other
+    alpha_t: torch.Tensor = torch.as_tensor(alpha, device=device, dtype=logits.dtype)
+    combined_loss: torch.Tensor = ((1 - alpha_t) * standard_loss + alpha_t * benign_loss).sum()
+
+    grads: List[torch.Tensor]
+    if gradient_mode == "embedding":
+        embed_grads = torch.autograd.grad(combined_loss, control_embeds)
+        grads = [
+            project_gradients(embed_grad, embed_weights, vocab_chunk_size, allowed_tokens)
+            for embed_grad in embed_grads
+        ]
+    else:
+        combined_loss.backward()
+        grads = [one_hot.grad.clone() for one_hot in one_hots]
+    if return_logits:
+        return grads, logits.detach()
+    return grads
+
+
+def project_gradients(
+    embed_grad: torch.Tensor,
+    embed_weights: torch.Tensor,
+    chunk_size: int = 8192,
+    allowed_tokens: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Projects a gradient with respect to token embeddings onto the vocabulary, i.e. computes
+    embed_grad @ embed_weights.T, one chunk of vocabulary rows at a time.
+
+    Parameters
+    ----------
+    embed_grad : torch.Tensor
+        Gradient with respect to the embeddings, shaped (tokens, hidden size).
+    embed_weights : torch.Tensor
+        The embedding matrix, shaped (vocab size, hidden size).
+    chunk_size : int
+        Vocabulary rows per matmul.
+    allowed_tokens : torch.Tensor, optional
+        Token ids to project onto; the other columns are set to +inf.
+
+    Returns
+    -------
+    torch.Tensor
+        The gradient with respect to each token choice, shaped (tokens, vocab size).
+    """
+    embed_weights = embed_weights.detach()
+    vocab_size: int = embed_weights.shape[0]
+    with torch.no_grad():
+        if allowed_tokens is None:
+            grad: torch.Tensor = torch.empty(
+                embed_grad.shape[0], vocab_size, device=embed_grad.device, dtype=embed_grad.dtype
+            )
+            for start in range(0, vocab_size, chunk_size):
+                grad[:, start : start + chunk_size] = (
+                    embed_grad @ embed_weights[start : start + chunk_size].T
+                )
+            return grad
+
+        grad = torch.full(
+            (embed_grad.shape[0], vocab_size),
+            float("inf"),
+            device=embed_grad.device,
+            dtype=embed_grad.dtype,
+        )
+        allowed_tokens = allowed_tokens.to(embed_grad.device)
+        for start in range(0, allowed_tokens.shape[0], chunk_size):
+            ids: torch.Tensor = allowed_tokens[start : start + chunk_size]
+            grad[:, ids] = embed_grad @ embed_weights[ids].T
+        return grad
 
-    # Combined loss with weighting
-    combined_loss: torch.Tensor = (1 - alpha) * standard_loss + alpha * benign_loss
-    combined_loss.backward()
 
-    return one_hot.grad.clone()
+def token_attributions(
+    model: AutoModelForSequenceClassification,
+    input_ids: torch.Tensor,
+    input_slice: slice,
+    device: torch.device,
+    reference_token_id: int,
+    benign_class: int = 0,
+    method: str = "gradient_x_input",
+    steps: int = 16,
+) -> torch.Tensor:
+    """
+    Estimates how much each token in input_slice contributes to the benign log-probability,
+    relative to replacing it with a reference token, using a single backward pass over the
+    token embeddings.
+
+    The reference must be a real token embedding rather than zero: DeBERTa-v3 normalizes each
+    token embedding before anything else sees it, so the model is invariant to rescaling an
+    embedding and gradient x input against a zero baseline is ~0 for every token.
+
+    Parameters
+    ----------
+    model : Transformer Model
+        The transformer model to be used.
+    input_ids : torch.Tensor
+        The input sequence in the form of token ids.
+    input_slice : slice
+        The slice of the input sequence whose tokens are attributed.
+    reference_token_id : int
+        Token whose embedding is the baseline, e.g. the mask or pad token.
+    benign_class : int
+        The benign class index.
+    method : str
+        "gradient_x_input" (gradient times the embedding difference to the reference) or
+        "integrated_gradients" (gradients averaged along the straight path from the reference
+        embedding, all steps in one batch).
+    steps : int
+        Number of path steps for integrated gradients.
+
+    Returns
+    -------
+    torch.Tensor
+        One contribution per token in the slice; low values mark tokens that matter least.
+    """
+    if method not in ("gradient_x_input", "integrated_gradients"):
+        raise ValueError(f"Unknown attribution method: {method}")
+
+    embed_layer = model.deberta.embeddings.word_embeddings
+    input_ids = input_ids.to(device)
+    with torch.no_grad():
+        embeds: torch.Tensor = embed_layer(input_ids)
+        reference: torch.Tensor = embed_layer(
+            torch.tensor([reference_token_id], device=device)
+        )[0]
+    control_embeds: torch.Tensor = embeds[input_slice]
+    deltas: torch.Tensor = control_embeds - reference
+
+    num_steps: int = steps if method == "integrated_gradients" else 1
+    scales: torch.Tensor = torch.linspace(
+        1.0 / num_steps, 1.0, num_steps, device=device, dtype=embeds.dtype
+    )
+    path_embeds: torch.Tensor = (reference + scales[:, None, None] * deltas.unsqueeze(0)).detach()
+    path_embeds.requires_grad_()
+
+    full_embeds: torch.Tensor = torch.cat(
+        [
+            embeds[: input_slice.start].expand(num_steps, -1, -1),
+            path_embeds,
+            embeds[input_slice.stop :].expand(num_steps, -1, -1),
+        ],
+        dim=1,
+    )
+    logits: torch.Tensor = model(inputs_embeds=full_embeds).logits
+    # Only the path embeddings need a gradient; nothing accumulates in the model parameters
+    (grads,) = torch.autograd.grad(
+        torch.log_softmax(logits, dim=-1)[:, benign_class].sum(), path_embeds
+    )
+
+    # Riemann approximation of the path integral (a single point for gradient x input)
+    return (grads.mean(dim=0) * deltas).sum(dim=-1).detach()
+
+
+def classify_ids(
+    model: AutoModelForSequenceClassification,
+    ids_list: Sequence[Sequence[int]],
+    pad_token_id: int,
+    device: torch.device,
+    batch_size: Optional[int] = None,
+    cache: Optional[ScoreCache] = None,
+    max_batch_tokens: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Classify assembled input id sequences (see PromptEncoder) in padded batches, halving the
+    batch limits on out-of-memory errors. Sequences are batched in order of length, so each
+    batch holds sequences of similar length and needs little padding.
+
+    Parameters:
+    -----------
+    model: The model to evaluate with
+    ids_list: Full input ids of each sequence, including special tokens
+    pad_token_id: Token id used for padding
+    batch_size: Maximum number of sequences per forward pass (None = all in one pass)
+    cache: Score cache; cached sequences are left out of the forward passes and the new
+           results are added to it
+    max_batch_tokens: Maximum padded tokens (sequences x longest length) per forward pass
+
+    Returns:
+    --------
+    Logits with one row per sequence
+    """
+    cached: Dict[int, torch.Tensor] = {}
+    missing: List[int] = list(range(len(ids_list)))
+    if cache is not None:
+        cached, missing = cache.lookup(ids_list)
+    missing_ids: List[Sequence[int]] = [ids_list[idx] for idx in missing]
+
+    batch_size = batch_size or max(1, len(missing_ids))
+    order: List[int] = sorted(range(len(missing_ids)), key=lambda i: len(missing_ids[i]))
+    computed_rows: List[Optional[torch.Tensor]] = [None] * len(missing_ids)
+    start: int = 0
+    while start < len(order):
+        # Extend the batch while it respects both limits; lengths only grow along `order`
+        end: int = start + 1
+        while (
+            end < len(order)
+            and end - start < batch_size
+            and (
+                max_batch_tokens is None
+                or (end - start + 1) * len(missing_ids[order[end]]) <= max_batch_tokens
+            )
+        ):
+            end += 1
+        batch_order: List[int] = order[start:end]
+        try:
+            with profiler.stage("forward"), torch.no_grad():
+                inputs = pad_batch(
+                    [missing_ids[i] for i in batch_order], pad_token_id, device=device
+                )
+                batch_logits: torch.Tensor = model(**inputs).logits
+        except torch.cuda.OutOfMemoryError:
+            if len(batch_order) == 1:
+                raise
+            batch_size = max(1, len(batch_order) // 2)
+            if max_batch_tokens is not None:
+                max_batch_tokens //= 2
+            torch.cuda.empty_cache()
+            print(f"  Out of memory, retrying with batches of {batch_size}")
+            continue
+        for i, row in zip(batch_order, batch_logits):
+            computed_rows[i] = row
+        start = end
+
+    computed: Optional[torch.Tensor] = torch.stack(computed_rows) if computed_rows else None
+    if computed is not None and cache is not None:
+        cache.store(missing_ids, computed)
+    if not cached:
+        return computed
+
+    # Reassemble the rows in input order
+    rows: List[Optional[torch.Tensor]] = [None] * len(ids_list)
+    for idx, row in cached.items():
+        rows[idx] = row.to(device)
+    for row_idx, idx in enumerate(missing):
+        rows[idx] = computed[row_idx]
+    return torch.stack(rows)
 
 
 def analyze_token_contributions(
@@ -321,22 +787,45 @@ def analyze_token_contributions(
     device: torch.device,
     min_acceptable_benign: float = 0.6,
     order_template: str = "{injection}{prefix}{text}",  # Template for ordering components
+    batched: bool = True,  # Score all leave-one-out variants of a round in one forward pass
+    encoder: Optional[PromptEncoder] = None,
+    strategy: str = "greedy",  # "greedy" (one token per round) or "block"
+    attribution: Optional[str] = None,  # "gradient_x_input" or "integrated_gradients"
+    attribution_candidates: int = 8,  # Removals evaluated per round when using attribution
 ) -> str:
     """
-    Simple, non-batched approach to remove as many tokens as possible while keeping
-    the benign score above the minimum acceptable threshold.
+    Remove as many tokens as possible while keeping the benign score above the minimum
+    acceptable threshold. Every round evaluates all leave-one-out variants of the current
+    prefix; with batched=True the variants of a round share one padded forward pass.
+
+    With an attribution method, each round first scores every token's contribution with one
+    backward pass (see token_attributions) and only evaluates the removals of the
+    attribution_candidates lowest-contribution tokens. The other removals are only evaluated
+    if none of those keeps the score above the threshold.
+
+    The "greedy" strategy removes the single token whose removal keeps the highest score.
+    The "block" strategy ranks the tokens by that score and first tries to remove the whole
+    block of tokens that are individually removable, halving the block (bisection) while the
+    score drops below the threshold, and only falls back to a single removal if no block of
+    two or more tokens passes. All block sizes of a round are scored in one batch.
     """
-    print("\n----- ANALYZING TOKEN CONTRIBUTIONS (NO BATCHING) -----")
+    print(
+        f"\n----- ANALYZING TOKEN CONTRIBUTIONS ({'BATCHED' if batched else 'NO BATCHING'}) -----"
+    )
+    if encoder is None:
+        encoder = PromptEncoder(tokenizer, injection_text, text, order_template)
+    pad_token_id: int = tokenizer.pad_token_id
+    # Baseline of the token attributions: what a token is compared against when it is removed
+    reference_token_id: int = (
+        tokenizer.mask_token_id if tokenizer.mask_token_id is not None else pad_token_id
+    )
 
     # Get baseline benign score
-    full_text = order_template.format(injection=injection_text, prefix=adv_prefix, text=text)
-    inputs = tokenizer(full_text, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-
-    with torch.no_grad():
-        logits = model(**inputs).logits
-        probs = torch.softmax(logits, dim=-1)
-        baseline_score = probs[0][benign_class_idx].item()
+    remaining_ids: List[int] = list(encoder.encode_prefix(adv_prefix))
+    logits = classify_ids(
+        model, [encoder.build_ids(remaining_ids)], pad_token_id, device, cache=score_cache
+    )
+    baseline_score = torch.softmax(logits, dim=-1)[0][benign_class_idx].item()
 
     print(f"Original prefix: '{adv_prefix}'")
     print(f"Original benign score: {baseline_score:.4f}")
@@ -351,68 +840,129 @@ def analyze_token_contributions(
         )
         return adv_prefix
 
-    current_prefix = adv_prefix
-    remaining_tokens = tokenizer.tokenize(current_prefix)
-    print(f"Starting with {len(remaining_tokens)} tokens")
+    print(f"Starting with {len(remaining_ids)} tokens")
 
     removed_tokens = []
 
-    while len(remaining_tokens) > 1:
-        # Try removing each token
-        best_candidate = None
-        best_score = -float("inf")
-        best_idx = -1
-
-        for i in range(len(remaining_tokens)):
-            # Create a new candidate with this token removed
-            tokens_without_i = remaining_tokens.copy()
-            token_to_remove = tokens_without_i.pop(i)
-            candidate_prefix = tokenizer.convert_tokens_to_string(tokens_without_i)
-
-            # Evaluate this candidate
-            full_text = order_template.format(
-                injection=injection_text, prefix=candidate_prefix, text=text
-            )
+    def evaluate_removals(indices: List[int]) -> None:
+        """Score the prefix without each of the given tokens, filling in `scores`."""
+        logits = classify_ids(
+            model,
+            [encoder.build_ids(remaining_ids[:i] + remaining_ids[i + 1 :]) for i in indices],
+            pad_token_id,
+            device,
+            batch_size=None if batched else 1,
+            cache=score_cache,
+        )
+        for i, score in zip(indices, torch.softmax(logits, dim=-1)[:, benign_class_idx].tolist()):
+            scores[i] = score
+            print(f"  Without token {i} ('{remaining_tokens[i]}'): score = {score:.4f}")
+
+    while len(remaining_ids) > 1:
+        # Try removing each token; removals that were not evaluated score -inf
+        remaining_tokens: List[str] = tokenizer.convert_ids_to_tokens(remaining_ids)
+        scores: List[float] = [float("-inf")] * len(remaining_ids)
+        indices: List[int] = list(range(len(remaining_ids)))
 
+        if attribution and len(remaining_ids) > attribution_candidates:
             try:
-                inputs = tokenizer(full_text, return_tensors="pt")
-                inputs = {k: v.to(device) for k, v in inputs.items()}
-
-                with torch.no_grad():
-                    logits = model(**inputs).logits
-                    probs = torch.softmax(logits, dim=-1)
-                    score = probs[0][benign_class_idx].item()
-
-                print(f"  Without token {i} ('{token_to_remove}'): score = {score:.4f}")
-
-                # If this is still above threshold and better than our current best
-                if score >= threshold and score > best_score:
-                    best_candidate = candidate_prefix
-                    best_score = score
-                    best_idx = i
-                    best_token = token_to_remove
+                input_ids, control_slice = encoder.build(remaining_ids, device=device)
+                contributions: torch.Tensor = token_attributions(
+                    model,
+                    input_ids,
+                    control_slice,
+                    device=device,
+                    reference_token_id=reference_token_id,
+                    benign_class=benign_class_idx,
+                    method=attribution,
+                )
+                indices = sorted(contributions.argsort()[:attribution_candidates].tolist())
+                print(f"  Lowest-contribution tokens by {attribution}: {indices}")
             except Exception as e:
-                print(f"  Error evaluating without token {i}: {e}")
+                print(f"  Error computing token attributions, evaluating all removals: {e}")
+
+        try:
+            evaluate_removals(indices)
+            if len(indices) < len(remaining_ids) and max(scores) < threshold:
+                # The attribution filter missed; fall back to the exact evaluation of the rest
+                evaluate_removals([i for i in range(len(remaining_ids)) if i not in set(indices)])
+        except Exception as e:
+            print(f"  Error evaluating token removals: {e}")
+            break
 
-        # If we found a valid candidate, update our prefix
-        if best_candidate:
-            current_prefix = best_candidate
-            removed_token = remaining_tokens.pop(best_idx)
-            removed_tokens.append(removed_token)
-            print(
-                f"✓ Removed token {best_idx} ('{best_token}'): new score = {best_score:.4f}, tokens left: {len(remaining_tokens)}"
-            )
-        else:
+        # Keep the removal with the best score that is still above threshold
+        valid: List[int] = [i for i, score in enumerate(scores) if score >= threshold]
+        if not valid:
             print(f"Cannot remove any more tokens while staying above threshold {threshold:.4f}")
             break
 
+        if strategy == "block" and len(valid) > 1:
+            # Least useful first: the prefix keeps the highest score without them
+            ranked: List[int] = sorted(valid, key=lambda i: scores[i], reverse=True)
+            block_sizes: List[int] = []
+            size: int = min(len(ranked), len(remaining_ids) - 1)
+            while size >= 2:
+                block_sizes.append(size)
+                size //= 2
+
+            if block_sizes:
+                blocks: List[set] = [set(ranked[:size]) for size in block_sizes]
+                block_variants: List[List[int]] = [
+                    [tok for j, tok in enumerate(remaining_ids) if j not in block]
+                    for block in blocks
+                ]
+                try:
+                    logits = classify_ids(
+                        model,
+                        [encoder.build_ids(variant) for variant in block_variants],
+                        pad_token_id,
+                        device,
+                        batch_size=None if batched else 1,
+                        cache=score_cache,
+                    )
+                    block_scores: List[float] = torch.softmax(logits, dim=-1)[
+                        :, benign_class_idx
+                    ].tolist()
+                except Exception as e:
+                    print(f"  Error evaluating token blocks: {e}")
+                    block_scores = [float("-inf")] * len(block_sizes)
+
+                # Largest block that keeps the score above threshold
+                passing: List[int] = [
+                    b for b, score in enumerate(block_scores) if score >= threshold
+                ]
+                if passing:
+                    b = passing[0]
+                    block: List[int] = sorted(blocks[b])
+                    block_tokens: List[str] = [remaining_tokens[i] for i in block]
+                    remaining_ids = block_variants[b]
+                    removed_tokens.extend(block_tokens)
+                    print(
+                        f"✓ Removed {len(block)} tokens {block_tokens}: new score = {block_scores[b]:.4f}, tokens left: {len(remaining_ids)}"
+                    )
+                    continue
+                print(f"  No block of {block_sizes[-1]}+ tokens can be removed, removing one token")
+
+        best_idx: int = max(valid, key=lambda i: scores[i])
+        remaining_ids.pop(best_idx)
+        removed_tokens.append(remaining_tokens[best_idx])
+        print(
+            f"✓ Removed token {best_idx} ('{remaining_tokens[best_idx]}'): new score = {scores[best_idx]:.4f}, tokens left: {len(remaining_ids)}"
+        )
+
+    current_prefix = (
+        tokenizer.convert_tokens_to_string(tokenizer.convert_ids_to_tokens(remaining_ids))
+        if removed_tokens
+        else adv_prefix
+    )
+
     # Final results
     print("\n===== TOKEN REMOVAL COMPLETE =====")
     print(f"Original prefix: '{adv_prefix}'")
     print(f"Final prefix: '{current_prefix}'")
     print(f"Removed {len(removed_tokens)} tokens: {removed_tokens}")
     print(f"Original token count: {len(tokenizer.tokenize(adv_prefix))}")
-    print(f"Final token count: {len(remaining_tokens)}")
+    print(f"Final token count: {len(remaining_ids)}")
 
     # Final verification
     full_text = order_template.format(injection=injection_text, prefix=current_prefix, text=text)
@@ -438,6 +988,12 @@ def minimize_tokens(
     benign_class_idx: int,
     device: torch.device,
     min_acceptable_benign: float = 0.6,
+    order_template: str = "{injection}{prefix}{text}",  # Template for ordering components
+    batched: bool = True,  # Batch the leave-one-out evaluations of each round
+    encoder: Optional[PromptEncoder] = None,  # Encoder of the template, built if not given
+    strategy: str = "greedy",  # "greedy" or "block" removal, see analyze_token_contributions
+    attribution: Optional[str] = None,  # Gradient attribution used to prune removal candidates
+    attribution_candidates: int = 8,  # Removals evaluated per round when using attribution
 ) -> str:
     """
     Minimize tokens using only token contribution analysis (ablation study).
@@ -447,20 +1003,34 @@ def minimize_tokens(
     Parameters:
     -----------
     token_length_weight: Weight for prioritizing removal of short tokens (0-1, higher = prioritize short tokens more)
+    order_template: Template string for ordering components (using {injection}, {prefix}, {text})
+    batched: Evaluate all leave-one-out variants of a round in one padded forward pass
+    encoder: PromptEncoder for this injection, text and template, reused if already built
+    strategy: "greedy" removes one token per round, "block" removes blocks with bisection backoff
+    attribution: "gradient_x_input" or "integrated_gradients" to only evaluate the removals of the
+                 lowest-contribution tokens each round (None evaluates every removal)
+    attribution_candidates: Number of lowest-contribution tokens evaluated per round
     """
     print("\n===== STARTING TOKEN MINIMIZATION =====")
 
     # Use only token ablation approach - systematically remove tokens that contribute least
-    ablation_prefix: str = analyze_token_contributions(
-        model,
-        tokenizer,
-        injection_text,
-        adv_prefix,
-        text,
-        benign_class_idx,
-        device=device,
-        min_acceptable_benign=min_acceptable_benign,
-    )
+    with profiler.stage("minimization"):
+        ablation_prefix: str = analyze_token_contributions(
+            model,
+            tokenizer,
+            injection_text,
+            adv_prefix,
+            text,
+            benign_class_idx,
+            device=device,
+            min_acceptable_benign=min_acceptable_benign,
+            order_template=order_template,
+            batched=batched,
+            encoder=encoder,
+            strategy=strategy,
+            attribution=attribution,
+            attribution_candidates=attribution_candidates,
+        )
 
     # Report final token count
     final_token_count: int = len(tokenizer.encode(ablation_prefix, add_special_tokens=False))
@@ -484,43 +1054,91 @@ def sample_control(
     topk: int = 256,
     temp: float = 1,
     not_allowed_tokens: Optional[torch.Tensor] = None,
+    num_coordinates: int = 1,
+    positions: str = "strided",
+    max_rounds: int = 4,
 ) -> torch.Tensor:
+    """
+    Sample candidate prefixes by replacing tokens with ones from the top-k of the negative
+    gradient at their position.
+
+    Parameters:
+    -----------
+    control_toks: Token ids of the current prefix
+    grad: Gradient of the loss with respect to each token choice, shaped (prefix length, vocab size)
+    batch_size: Number of candidates to return
+    topk: Number of best tokens per position to sample replacements from
+    temp: Temperature of the position weights when positions="gradient"
+    not_allowed_tokens: Token ids that must never be sampled
+    num_coordinates: Number of positions replaced in each candidate
+    positions: How the replaced positions are picked: "strided" (evenly spread over the batch),
+               "random", or "gradient" (weighted by the best gradient improvement at the position)
+    max_rounds: Sampling rounds used to fill the batch with distinct candidates
+
+    Returns:
+    --------
+    Up to batch_size distinct candidates that differ from control_toks, shaped (candidates, prefix length).
+    The batch is only smaller if max_rounds could not produce enough distinct candidates.
+    """
     if not_allowed_tokens is not None:
         grad[:, not_allowed_tokens.to(grad.device)] = float("inf")
 
-    top_indices: torch.Tensor = (-grad).topk(topk, dim=1).indices
+    top_values, top_indices = (-grad).topk(topk, dim=1)
     control_toks = control_toks.to(grad.device)
+    prefix_length: int = len(control_toks)
+    num_coordinates = max(1, min(num_coordinates, prefix_length))
+
+    candidates: torch.Tensor = control_toks.new_empty((0, prefix_length))
+    for _ in range(max_rounds):
+        # Positions to replace, one row of num_coordinates distinct positions per candidate
+        if positions == "random":
+            new_token_pos: torch.Tensor = torch.rand(
+                batch_size, prefix_length, device=grad.device
+            ).argsort(dim=1)[:, :num_coordinates]
+        elif positions == "gradient":
+            # Clamped so that every position stays drawable without replacement
+            weights: torch.Tensor = torch.softmax(top_values[:, 0] / temp, dim=0).clamp_min(1e-12)
+            new_token_pos = torch.multinomial(
+                weights.repeat(batch_size, 1), num_coordinates, replacement=False
+            )
+        elif positions == "strided":
+            # Candidate b starts at position b * length / batch_size, like the original
+            # evenly strided positions, and wraps around when the batch exceeds the length
+            starts: torch.Tensor = (
+                torch.arange(batch_size, device=grad.device) * prefix_length // batch_size
+            )
+            offsets: torch.Tensor = (
+                torch.arange(num_coordinates, device=grad.device) * (prefix_length // num_coordinates)
+            )
+            new_token_pos = (starts.unsqueeze(1) + offsets) % prefix_length
+        else:
+            raise ValueError(f"Unknown position strategy: {positions}")
 
-    original_control_toks: torch.Tensor = control_toks.repeat(batch_size, 1)
-
-    # Ensure batch_size doesn't exceed the size of control_toks
-    actual_batch_size: int = min(batch_size, len(control_toks))
-
-    new_token_pos: torch.Tensor = torch.arange(
-        0,
-        len(control_toks),
-        max(1, len(control_toks) / actual_batch_size),  # Ensure step is at least 1
-        device=grad.device,
-    ).type(torch.int64)
+        new_token_val: torch.Tensor = top_indices[
+            new_token_pos, torch.randint(0, topk, new_token_pos.shape, device=grad.device)
+        ]
+        new_control_toks: torch.Tensor = control_toks.repeat(batch_size, 1).scatter_(
+            1, new_token_pos, new_token_val
+        )
 
-    # Extra safety: ensure new_token_pos is within bounds of top_indices' first dimension
-    new_token_pos = torch.clamp(new_token_pos, 0, grad.shape[0] - 1)
+        # Drop duplicates and candidates that did not change the prefix
+        candidates = torch.unique(torch.cat([candidates, new_control_toks]), dim=0)
+        candidates = candidates[(candidates != control_toks).any(dim=1)]
+        if len(candidates) >= batch_size:
+            break
 
-    new_token_val: torch.Tensor = torch.gather(
-        top_indices[new_token_pos],
-        1,
-        torch.randint(0, topk, (len(new_token_pos), 1), device=grad.device),
-    )
+    if len(candidates) == 0:
+        # Every replacement was the current token; keep the search going with the prefix itself
+        return control_toks.unsqueeze(0)
 
-    # Ensure we don't exceed the original batch size dimension
-    new_control_toks: torch.Tensor = original_control_toks[: len(new_token_pos)].scatter_(
-        1, new_token_pos.unsqueeze(-1), new_token_val
-    )
+    # Shuffle so a truncated batch is not biased by the sorting of torch.unique
+    candidates = candidates[torch.randperm(len(candidates), device=grad.device)]
+    return candidates[:batch_size]
 
-    return new_control_toks
 
-
-def get_random_words(n: int = 10, min_uses: int = 0, token_priority: float = 0.3) -> List[str]:
+def get_random_words(
+    n: int = 10, min_uses: int = 0, token_priority: float = 0.3, context: Optional[str] = None
+) -> List[str]:
     """
     Get a list of words to use, prioritizing words that have performed well in the past.
 
@@ -530,6 +1148,7 @@ def get_random_words(n: int = 10, min_uses: int = 0, token_priority: float = 0.3
     min_uses: Minimum number of uses a word must have to be considered from the database
     token_priority: How much to prioritize words with fewer tokens (0-1)
                    0 = purely improvement based, 1 = purely token count based
+    context: Search context to prefer the statistics of (see wordsdb.context_key)
 
     Returns:
     --------
@@ -538,14 +1157,22 @@ def get_random_words(n: int = 10, min_uses: int = 0, token_priority: float = 0.3
     # Try to get high-performing words from the database
     if token_priority <= 0:
         # Sort purely by improvement
-        top_words = words_db.get_top_words(limit=n, min_uses=min_uses, sort_by="improvement")
+        top_words = words_db.get_top_words(
+            limit=n, min_uses=min_uses, sort_by="improvement", context=context
+        )
     elif token_priority >= 1:
         # Sort purely by token count (ascending)
-        top_words = words_db.get_top_words(limit=n, min_uses=min_uses, sort_by="tokens")
+        top_words = words_db.get_top_words(
+            limit=n, min_uses=min_uses, sort_by="tokens", context=context
+        )
     else:
         # Use combined sorting with the specified token weight
         top_words = words_db.get_top_words(
-            limit=n, min_uses=min_uses, sort_by="combined", token_weight=token_priority
+            limit=n,
+            min_uses=min_uses,
+            sort_by="combined",
+            token_weight=token_priority,
+            context=context,
         )
 
     # If we got enough words from the database, use them
@@ -557,14 +1184,135 @@ def get_random_words(n: int = 10, min_uses: int = 0, token_priority: float = 0.3
     return top_words + random.choices(words, k=remaining)
 
 
+# Process-wide memo of token counts, keyed by (model, text)
+_token_count_cache: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+TOKEN_COUNT_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoder(model: str = "gpt-3.5") -> Optional["tiktoken.Encoding"]:
+    """
+    Load the tiktoken encoder for a model once per process. Returns None, with a one-time
+    warning, if it cannot be loaded (e.g. the encoding files cannot be downloaded offline).
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        print(
+            f"Warning: could not load the tiktoken encoder for '{model}' ({e}). "
+            "Falling back to whitespace-separated word counts."
+        )
+        return None
+
+
+def _cache_token_count(key: Tuple[str, str], count: int) -> None:
+    _token_count_cache[key] = count
+    if len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+        _token_count_cache.popitem(last=False)
+
+
 def count_tokens(text: str, model: str = "gpt-3.5") -> int:
     """Count the number of tokens in a text string using tiktoken."""
-    try:
-        encoder = tiktoken.encoding_for_model(model)
-        return len(encoder.encode(text))
-    except:
-        # Fallback to a simple approximation if tiktoken fails
-        return len(text.split())
+    return count_tokens_batch([text], model=model)[0]
+
+
+def count_tokens_batch(texts: List[str], model: str = "gpt-3.5") -> List[int]:
+    """
+    Count the tokens of several strings, encoding the ones not seen before in a single
+    tiktoken batch call. Counts are memoized in a bounded LRU cache.
+    """
+    counts: List[Optional[int]] = []
+    missing: Dict[str, List[int]] = {}
+    for idx, text in enumerate(texts):
+        key = (model, text)
+        count = _token_count_cache.get(key)
+        if count is None:
+            missing.setdefault(text, []).append(idx)
+        else:
+            _token_count_cache.move_to_end(key)
+        counts.append(count)
+
+    if missing:
+        missing_texts: List[str] = list(missing)
+        encoder = get_token_encoder(model)
+        if encoder is None:
+            # Fallback to a simple approximation if tiktoken is unavailable
+            new_counts: List[int] = [len(text.split()) for text in missing_texts]
+        else:
+            new_counts = [
+                len(tokens)
+                for tokens in encoder.encode_batch(missing_texts, disallowed_special=())
+            ]
+        for text, count in zip(missing_texts, new_counts):
+            _cache_token_count((model, text), count)
+            for idx in missing[text]:
+                counts[idx] = count
+
+    return counts
+
+
+def score_candidates(
+    logits: torch.Tensor,
+    benign_class_idx: int,
+    token_counts: Optional[Sequence[int]] = None,
+    alpha: float = 0.5,
+    token_penalty_weight: float = 0.1,
+    relative_to_min: bool = True,
+) -> Dict[str, torch.Tensor]:
+    """
+    Score a batch of candidates from their logits, entirely on the logits' device.
+
+    Parameters
+    ----------
+    logits : torch.Tensor
+        Classifier logits, one row per candidate.
+    benign_class_idx : int
+        Index of the benign class.
+    token_counts : sequence of int, optional
+        Token count of each candidate prefix; without it no token penalty is applied.
+    alpha : float
+        Weight for the benign score (1-alpha is weight for loss)
+    token_penalty_weight : float
+        Weight for token count penalty (higher values penalize longer prefixes more)
+    relative_to_min : bool
+        Normalize token counts over the batch's [min, max] range instead of [0, max].
+
+    Returns
+    -------
+    dict of torch.Tensor
+        "benign" probabilities, "normalized_loss", "token_penalty" (0-1, higher = fewer
+        tokens) and the "combined" score, each with one value per candidate.
+    """
+    probs: torch.Tensor = torch.softmax(logits, dim=-1)
+    benign: torch.Tensor = probs[:, benign_class_idx]
+
+    # Convert the loss to 0-1 range where higher is better
+    losses: torch.Tensor = nn.CrossEntropyLoss(reduction="none")(
+        logits, torch.zeros(logits.shape[0], device=logits.device, dtype=torch.long)
+    )
+    normalized_loss: torch.Tensor = 1.0 / (1.0 + losses)
+
+    if token_counts is None or len(token_counts) == 0:
+        token_penalty: torch.Tensor = torch.ones_like(benign)
+    else:
+        counts: torch.Tensor = torch.as_tensor(
+            token_counts, device=logits.device, dtype=benign.dtype
+        )
+        if relative_to_min:
+            count_range: torch.Tensor = (counts.max() - counts.min()).clamp(min=1)
+            token_penalty = 1.0 - (counts - counts.min()) / count_range
+        else:
+            token_penalty = 1.0 - (counts / counts.max().clamp(min=1)).clamp(max=1.0)
+
+    combined: torch.Tensor = (alpha * benign + (1 - alpha) * normalized_loss) * (
+        1 - token_penalty_weight + token_penalty_weight * token_penalty
+    )
+    return {
+        "benign": benign,
+        "normalized_loss": normalized_loss,
+        "token_penalty": token_penalty,
+        "combined": combined,
+    }
 
 
 def get_combined_score(
@@ -592,8 +1340,6 @@ def get_combined_score(
         List of candidate prefix strings to evaluate.
     benign_idx : int
         Index of the benign class.
-    malicious_idx : int
-        Index of the malicious class.
     alpha : float
         Weight for the benign score (1-alpha is weight for loss)
     token_penalty_weight : float
@@ -604,46 +1350,30 @@ def get_combined_score(
     int
         Index of the candidate with the best combined score.
     """
-    best_combined_score: float = float("-inf")
-    best_idx: int = 0
-
-    # Find max token count for normalization
-    token_counts: List[int] = [count_tokens(candidate) for candidate in candidates]
-    max_token_count: int = max(token_counts) if token_counts else 1
-
-    for idx, candidate in enumerate(candidates):
-        inputs: Dict[str, torch.Tensor] = tokenizer(candidate + text, return_tensors="pt")
-        # Move inputs to MPS device
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        with torch.no_grad():
-            logits: torch.Tensor = model(**inputs).logits
-            probs: torch.Tensor = torch.softmax(logits, dim=-1)
-
-            # Calculate loss component (lower is better)
-            loss: torch.Tensor = nn.CrossEntropyLoss()(
-                logits, torch.zeros(logits.shape[0], device=device).long()
-            )
-            normalized_loss: float = 1.0 / (
-                1.0 + loss.item()
-            )  # Convert to 0-1 range where higher is better
-
-            # Calculate benign score component (higher is better)
-            benign_score: float = probs[0][benign_idx].item()
-
-            # Calculate token count penalty (normalized to 0-1, where higher is better = fewer tokens)
-            token_count: int = token_counts[idx]
-            token_penalty: float = 1.0 - (token_count / max_token_count)
-
-            # Calculate combined score with token penalty
-            combined_score: float = (alpha * benign_score + (1 - alpha) * normalized_loss) * (
-                1 - token_penalty_weight + token_penalty_weight * token_penalty
-            )
-
-            if combined_score > best_combined_score:
-                best_combined_score = combined_score
-                best_idx = idx
+    if not candidates:
+        return 0
+
+    # All candidates are classified in one padded batch
+    inputs: Dict[str, torch.Tensor] = tokenizer(
+        [candidate + text for candidate in candidates],
+        return_tensors="pt",
+        padding=True,
+        truncation=True,
+    )
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    with torch.no_grad():
+        logits: torch.Tensor = model(**inputs).logits
+
+    scores = score_candidates(
+        logits,
+        benign_idx,
+        count_tokens_batch(candidates),
+        alpha=alpha,
+        token_penalty_weight=token_penalty_weight,
+        relative_to_min=False,
+    )
+    return int(scores["combined"].argmax().item())
 
-    return best_idx
 
 def get_filtered_cands(tokenizer, control_cand, filter_cand=True, curr_control=None):
     cands, count = [], 0
@@ -660,4 +1390,33 @@ def get_filtered_cands(tokenizer, control_cand, filter_cand=True, curr_control=N
     if filter_cand:
         cands = cands + [cands[-1]] * (len(control_cand) - len(cands))
         # print(f"Warning: {round(count / len(control_cand), 2)} control candidates were not valid")
-    return cands
\ No newline at end of file
+    return cands
+
+
+def consistent_cands_mask(
+    tokenizer: AutoTokenizer,
+    control_cand: List[List[int]],
+    decoded: List[str],
+    curr_control: Optional[str] = None,
+) -> List[bool]:
+    """
+    Bulk version of the get_filtered_cands check: a candidate is kept if its decoded text
+    differs from the current prefix and encodes back to exactly the same token ids.
+    All candidates are re-encoded with a single tokenizer call.
+
+    Parameters:
+    -----------
+    tokenizer: The tokenizer to use
+    control_cand: Candidate token ids, one list per candidate
+    decoded: The decoded text of each candidate
+    curr_control: The current prefix text
+
+    Returns:
+    --------
+    One flag per candidate, True if the candidate is kept
+    """
+    reencoded: List[List[int]] = tokenizer(decoded, add_special_tokens=False)["input_ids"]
+    return [
+        text != curr_control and ids == list(toks)
+        for text, ids, toks in zip(decoded, reencoded, control_cand)
+    ]
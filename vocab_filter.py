@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers import AutoTokenizer
+
+from utils import count_tokens_batch
+from words import words
+
+# Filters applied when the configuration does not set them
+DEFAULT_FILTERS: Dict[str, Any] = {
+    "ascii_only": False,  # Only tokens whose text is printable ASCII
+    "word_start_only": False,  # Only tokens that start a new word
+    "from_words": False,  # Only tokens that appear in the tokenization of words.py
+    "max_tiktoken_cost": None,  # Only tokens costing at most this many tiktoken tokens
+}
+
+# Masks and token id lists already built in this process, keyed like the disk cache
+_masks: Dict[str, torch.Tensor] = {}
+_token_ids: Dict[Tuple[str, bool, str], torch.Tensor] = {}
+
+
+def is_clean(text: str) -> bool:
+    """Whether a token text is non-empty and free of control and unassigned characters."""
+    return bool(text.strip()) and not any(
+        unicodedata.category(char) in ("Cc", "Cf", "Cn", "Co", "Cs") for char in text
+    )
+
+
+def build_token_mask(
+    tokenizer: AutoTokenizer, filters: Dict[str, Any], vocab_size: Optional[int] = None
+) -> torch.Tensor:
+    """
+    Build the allowed-token mask of a tokenizer.
+
+    Special tokens, empty tokens and tokens with control characters or byte-fallback pieces
+    (e.g. <0x0A>) are never allowed; `filters` (see DEFAULT_FILTERS) restrict the rest.
+
+    Parameters:
+    -----------
+    tokenizer: The tokenizer whose vocabulary is filtered
+    filters: Filter settings, missing keys use DEFAULT_FILTERS
+    vocab_size: Size of the mask, e.g. the rows of the embedding matrix; ids beyond the
+                tokenizer's vocabulary are not allowed
+
+    Returns:
+    --------
+    Boolean tensor with one entry per token id, True where the token may be sampled
+    """
+    filters = {**DEFAULT_FILTERS, **filters}
+    tokens: List[str] = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    # Surface text of every token, with the word-start marker turned into a space
+    texts: List[str] = [(token or "").replace("▁", " ") for token in tokens]
+    allowed: List[bool] = [
+        is_clean(text) and not (token or "").startswith("<0x") for token, text in zip(tokens, texts)
+    ]
+    for token_id in tokenizer.all_special_ids:
+        if token_id < len(allowed):
+            allowed[token_id] = False
+
+    if filters["ascii_only"]:
+        allowed = [a and text.isascii() and text.isprintable() for a, text in zip(allowed, texts)]
+    if filters["word_start_only"]:
+        allowed = [a and text.startswith(" ") for a, text in zip(allowed, texts)]
+    if filters["from_words"]:
+        word_ids = set()
+        for word in words:
+            word_ids.update(tokenizer(word, add_special_tokens=False)["input_ids"])
+            word_ids.update(tokenizer(" " + word, add_special_tokens=False)["input_ids"])
+        allowed = [a and token_id in word_ids for token_id, a in enumerate(allowed)]
+    if filters["max_tiktoken_cost"] is not None:
+        candidates: List[int] = [token_id for token_id, a in enumerate(allowed) if a]
+        costs: List[int] = count_tokens_batch([texts[token_id] for token_id in candidates])
+        for token_id, cost in zip(candidates, costs):
+            if cost > filters["max_tiktoken_cost"]:
+                allowed[token_id] = False
+
+    mask: torch.Tensor = torch.zeros(vocab_size or len(allowed), dtype=torch.bool)
+    count: int = min(len(mask), len(allowed))
+    mask[:count] = torch.tensor(allowed[:count], dtype=torch.bool)
+    return mask
+
+
+def mask_key(tokenizer: AutoTokenizer, filters: Dict[str, Any], vocab_size: Optional[int]) -> str:
+    """Cache key of a mask: the tokenizer, the mask size and the filters."""
+    key_source: str = json.dumps(
+        {
+            "tokenizer": getattr(tokenizer, "name_or_path", ""),
+            "tokenizer_size": len(tokenizer),
+            "vocab_size": vocab_size,
+            "filters": {**DEFAULT_FILTERS, **filters},
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_source.encode()).hexdigest()[:16]
+
+
+def allowed_token_mask(
+    tokenizer: AutoTokenizer,
+    filters: Dict[str, Any],
+    vocab_size: Optional[int] = None,
+    cache_dir: Optional[str] = ".vocab_cache",
+) -> torch.Tensor:
+    """
+    Allowed-token mask of a tokenizer, built once and cached in memory and on disk.
+
+    Parameters:
+    -----------
+    tokenizer: The tokenizer whose vocabulary is filtered
+    filters: Filter settings, see DEFAULT_FILTERS
+    vocab_size: Size of the mask, see build_token_mask
+    cache_dir: Directory of the cached masks (None disables the disk cache)
+
+    Returns:
+    --------
+    Boolean tensor with one entry per token id, True where the token may be sampled
+    """
+    key: str = mask_key(tokenizer, filters, vocab_size)
+    if key in _masks:
+        return _masks[key]
+
+    path: Optional[str] = os.path.join(cache_dir, f"{key}.pt") if cache_dir else None
+    if path and os.path.exists(path):
+        mask: torch.Tensor = torch.load(path)
+    else:
+        mask = build_token_mask(tokenizer, filters, vocab_size)
+        print(f"Vocabulary filter allows {int(mask.sum())} of {len(mask)} tokens")
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.save(mask, path)
+    _masks[key] = mask
+    return mask
+
+
+def token_ids(
+    tokenizer: AutoTokenizer,
+    filters: Dict[str, Any],
+    allowed: bool = True,
+    vocab_size: Optional[int] = None,
+    device: Optional[torch.device] = None,
+    cache_dir: Optional[str] = ".vocab_cache",
+) -> torch.Tensor:
+    """
+    Ids of the tokens allowed by the filters, or of the excluded ones with allowed=False (as
+    sample_control's not_allowed_tokens expects). Cached per device.
+    """
+    cache_key = (mask_key(tokenizer, filters, vocab_size), allowed, str(device))
+    ids: Optional[torch.Tensor] = _token_ids.get(cache_key)
+    if ids is None:
+        mask: torch.Tensor = allowed_token_mask(tokenizer, filters, vocab_size, cache_dir)
+        ids = (mask if allowed else ~mask).nonzero().squeeze(1).to(device)
+        _token_ids[cache_key] = ids
+    return ids
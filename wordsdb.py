@@ -1,26 +1,326 @@
+import argparse
+import atexit
+import bisect
+import hashlib
+import heapq
 import sqlite3
+import threading
+import uuid
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
+
+import numpy as np
+
+# Raw record: (word, position, benign_score, improvement, token_count, combined_score, context)
+Record = Tuple[str, str, float, float, int, float, Optional[str]]
+
+# Folds one record into an aggregate row; {table} is word_stats or context_word_stats
+STATS_UPSERT = """
+INSERT INTO {table}
+({keys}, avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position)
+VALUES ({key_params}, ?, ?, ?, ?, 1, ?)
+ON CONFLICT({keys}) DO UPDATE SET
+    avg_improvement = (avg_improvement * use_count + ?) / (use_count + 1),
+    max_improvement = MAX(max_improvement, ?),
+    avg_token_count = (avg_token_count * use_count + ?) / (use_count + 1),
+    min_token_count = MIN(min_token_count, ?),
+    use_count = use_count + 1,
+    best_position = CASE WHEN ? > max_improvement THEN ? ELSE best_position END,
+    last_updated = CURRENT_TIMESTAMP
+"""
+
+
+def merge_stats(values: List[Any], other: List[Any]) -> List[Any]:
+    """
+    Combine two aggregate rows (STATS_COLUMNS order) of the same word, weighting the averages
+    by use count.
+    """
+    avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best = values
+    o_avg_improvement, o_max_improvement, o_avg_token_count, o_min_token_count, o_use_count, o_best = other
+    total = use_count + o_use_count
+    return [
+        (avg_improvement * use_count + o_avg_improvement * o_use_count) / total,
+        max(max_improvement, o_max_improvement),
+        (avg_token_count * use_count + o_avg_token_count * o_use_count) / total,
+        min(min_token_count, o_min_token_count),
+        total,
+        o_best if o_max_improvement > max_improvement else best,
+    ]
+
+
+STATS_COLUMNS = [
+    "avg_improvement",
+    "max_improvement",
+    "avg_token_count",
+    "min_token_count",
+    "use_count",
+    "best_position",
+]
+RAW_COLUMNS = [
+    "word",
+    "position",
+    "benign_score",
+    "improvement",
+    "token_count",
+    "combined_score",
+    "context",
+    "timestamp",
+]
+
+
+def context_key(model_id: str, injection_text: str, text: str, order_template: str) -> str:
+    """Short stable hash identifying the search context that word statistics were measured in."""
+    digest = hashlib.sha256("\x1f".join([model_id, injection_text, text, order_template]).encode())
+    return digest.hexdigest()[:16]
+
+
+def stats_params(key: Tuple, record: Record) -> Tuple:
+    """Parameters of STATS_UPSERT for one record."""
+    word, position, _, improvement, token_count, _, _ = record
+    return (
+        *key,
+        improvement,
+        improvement,
+        token_count,
+        token_count,
+        position,
+        improvement,
+        improvement,
+        token_count,
+        token_count,
+        improvement,
+        position,
+    )
+
+
+class WordIndex:
+    """
+    In-memory copy of the statistics of one scope (global or one context), local and merged,
+    with maintained rankings.
+
+    Words are kept in two sorted lists, by average improvement and by token count, which are
+    updated with bisect as records arrive. Top-k queries walk the lists from the front, and the
+    "combined" ranking merges both lists with the threshold algorithm, so queries only look at
+    the first entries instead of sorting the whole table.
+    """
+
+    def __init__(self, rows: List[Tuple] = ()):
+        # word -> [avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position]
+        self.stats: Dict[str, List[Any]] = {}
+        self.by_improvement: List[Tuple[float, str]] = []  # (-avg_improvement, word)
+        self.by_tokens: List[Tuple[int, float, str]] = []  # (min_token_count, -avg_improvement, word)
+        for word, *values in rows:
+            # A word can have rows from several sources (see WordsDatabase.merge_npz)
+            known = self.stats.get(word)
+            self.stats[word] = list(values) if known is None else merge_stats(known, values)
+        for word in self.stats:
+            self.by_improvement.append(self._improvement_key(word))
+            self.by_tokens.append(self._tokens_key(word))
+        self.by_improvement.sort()
+        self.by_tokens.sort()
+
+    def _improvement_key(self, word: str) -> Tuple[float, str]:
+        return (-self.stats[word][0], word)
+
+    def _tokens_key(self, word: str) -> Tuple[int, float, str]:
+        return (self.stats[word][3], -self.stats[word][0], word)
+
+    def _remove(self, sorted_list: List[Tuple], key: Tuple):
+        idx = bisect.bisect_left(sorted_list, key)
+        if idx < len(sorted_list) and sorted_list[idx] == key:
+            del sorted_list[idx]
+
+    def add(self, word: str, position: str, improvement: float, token_count: int):
+        """Fold one record into the statistics, mirroring STATS_UPSERT."""
+        values = self.stats.get(word)
+        if values is None:
+            self.stats[word] = [improvement, improvement, token_count, token_count, 1, position]
+        else:
+            self._remove(self.by_improvement, self._improvement_key(word))
+            self._remove(self.by_tokens, self._tokens_key(word))
+            avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best = values
+            self.stats[word] = [
+                (avg_improvement * use_count + improvement) / (use_count + 1),
+                max(max_improvement, improvement),
+                (avg_token_count * use_count + token_count) / (use_count + 1),
+                min(min_token_count, token_count),
+                use_count + 1,
+                position if improvement > max_improvement else best,
+            ]
+        bisect.insort(self.by_improvement, self._improvement_key(word))
+        bisect.insort(self.by_tokens, self._tokens_key(word))
+
+    def _qualifies(self, word: str, min_uses: int) -> bool:
+        return self.stats[word][4] >= min_uses and self.stats[word][0] > 0
+
+    def top(self, limit: int, min_uses: int, sort_by: str, token_weight: float) -> List[str]:
+        """Top words among those used at least min_uses times with a positive average improvement."""
+        if limit <= 0:
+            return []
+        if sort_by == "tokens":
+            # Sort by token count (ascending) then by improvement (descending)
+            top_words = []
+            for _, _, word in self.by_tokens:
+                if len(top_words) >= limit:
+                    break
+                if self._qualifies(word, min_uses):
+                    top_words.append(word)
+            return top_words
+        if sort_by != "combined":
+            # Default: sort by improvement, which also ends at the first non-positive improvement
+            top_words = []
+            for neg_improvement, word in self.by_improvement:
+                if -neg_improvement <= 0 or len(top_words) >= limit:
+                    break
+                if self.stats[word][4] >= min_uses:
+                    top_words.append(word)
+            return top_words
+
+        # Normalization bounds over the qualifying words
+        max_improvement = next(
+            (-key for key, word in self.by_improvement if self._qualifies(word, min_uses)), None
+        )
+        if max_improvement is None:
+            return []
+        max_tokens = next(
+            key[0] for key in reversed(self.by_tokens) if self._qualifies(key[2], min_uses)
+        )
+        improvement_scale = (1 - token_weight) / max_improvement if max_improvement > 0 else 0
+        tokens_scale = token_weight / max_tokens if max_tokens > 0 else 0
+
+        def combined(word: str) -> float:
+            # Same ordering as (1 - w) * improvement / max + w * (1 - tokens / max)
+            return improvement_scale * self.stats[word][0] - tokens_scale * self.stats[word][3]
+
+        # Threshold algorithm: read both rankings in parallel until no unseen word can beat
+        # the current top `limit` scores
+        scored: Dict[str, float] = {}
+        best: List[Tuple[float, str]] = []  # min-heap of the top scores
+        for depth in range(len(self.stats)):
+            neg_improvement, improvement_word = self.by_improvement[depth]
+            min_tokens, _, tokens_word = self.by_tokens[depth]
+            for word in (improvement_word, tokens_word):
+                if word in scored or not self._qualifies(word, min_uses):
+                    continue
+                scored[word] = combined(word)
+                heapq.heappush(best, (scored[word], word))
+                if len(best) > limit:
+                    heapq.heappop(best)
+            threshold = improvement_scale * -neg_improvement - tokens_scale * min_tokens
+            if len(best) >= limit and best[0][0] >= threshold:
+                break
+        return [word for _, word in sorted(best, key=lambda x: x[0], reverse=True)]
 
 
 class WordsDatabase:
     """
     Database to track the performance of words when added to a prefix.
     Stores word statistics and allows querying for top-performing words.
+
+    Records are buffered in memory and written in a single transaction once buffer_size records
+    are pending, optionally by a background writer thread. Queries flush pending records first.
+
+    Records made with a context (see context_key) are also aggregated per context, so queries for
+    that context rank words by how they did against the same model, texts and template.
+
+    Queries are answered from WordIndex copies of the statistics, loaded on first use and kept
+    up to date as records are written.
+
+    Nothing reads the raw word_performance rows back during a search, so they can be limited to
+    the newest max_rows rows and/or the last max_days days, or not stored at all (store_raw).
+
+    word_stats and context_word_stats only hold locally recorded statistics. Statistics merged
+    from other databases are kept per source database in merged_word_stats and combined with the
+    local ones when the rankings are loaded, so exports never carry merged statistics back.
     """
 
-    def __init__(self, db_path: str = "word_performance.db"):
+    def __init__(
+        self,
+        db_path: str = "word_performance.db",
+        buffer_size: int = 256,
+        background: bool = False,
+        flush_interval: float = 1.0,
+    ):
         """Initialize the database, creating tables if they don't exist."""
         self.db_path = db_path
         self.conn = None
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._pending: List[Record] = []
+        self._indexes: Dict[Optional[str], WordIndex] = {}  # None is the global index
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self.max_rows: int = 0  # 0 keeps every raw row
+        self.max_days: float = 0
+        self.store_raw: bool = True
+        self.source_id: Optional[str] = None
         self.initialize_db()
+        self.configure(background=background)
+        atexit.register(self.close)
+
+    def configure(
+        self,
+        buffer_size: Optional[int] = None,
+        background: Optional[bool] = None,
+        max_rows: Optional[int] = None,
+        max_days: Optional[float] = None,
+        store_raw: Optional[bool] = None,
+    ):
+        """
+        Change how records are written. Arguments left at None keep their current value.
+
+        Parameters:
+        -----------
+        buffer_size: Number of pending records that triggers a write (1 writes every record)
+        background: Write pending records from a background thread instead of the caller
+        max_rows: Keep only the newest max_rows raw rows (0 = no limit)
+        max_days: Keep only raw rows younger than max_days days (0 = no limit)
+        store_raw: Store raw rows at all; False only maintains the aggregated statistics
+        """
+        if buffer_size is not None:
+            self.buffer_size = max(1, int(buffer_size))
+        if max_rows is not None:
+            self.max_rows = max(0, int(max_rows))
+        if max_days is not None:
+            self.max_days = max(0.0, float(max_days))
+        if store_raw is not None:
+            self.store_raw = bool(store_raw)
+        if background and self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+        elif background is False and self._writer is not None:
+            self._stop_writer()
+
+    def _write_loop(self):
+        """Background writer: flush whenever woken up or every flush_interval seconds."""
+        while self._writer is threading.current_thread():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the writer alive; the records stay pending for the next attempt
+                print(f"Error in background word performance writer: {e}")
+
+    def _stop_writer(self):
+        writer = self._writer
+        self._writer = None
+        self._wake.set()
+        if writer is not None and writer is not threading.current_thread():
+            writer.join()
 
     def initialize_db(self):
         """Create the database tables if they don't exist."""
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # Shared with the background writer; every access holds self._lock
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
             cursor = self.conn.cursor()
 
+            # Write-ahead logging: readers do not block the writer and commits need fewer fsyncs
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+
             # Create table for word performance
             cursor.execute(
                 """
@@ -53,6 +353,83 @@ class WordsDatabase:
             """
             )
 
+            # Same statistics aggregated per search context
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS context_word_stats (
+                context TEXT NOT NULL,
+                word TEXT NOT NULL,
+                avg_improvement REAL NOT NULL,
+                max_improvement REAL NOT NULL,
+                avg_token_count REAL NOT NULL,
+                min_token_count INTEGER NOT NULL,
+                use_count INTEGER NOT NULL,
+                best_position TEXT NOT NULL,
+                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (context, word)
+            )
+            """
+            )
+
+            # Databases created before context keys have no context column
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(word_performance)")]
+            if "context" not in columns:
+                cursor.execute("ALTER TABLE word_performance ADD COLUMN context TEXT")
+
+            # Raw rows merged from another database carry its source id (NULL for local rows)
+            if "source" not in columns:
+                cursor.execute("ALTER TABLE word_performance ADD COLUMN source TEXT")
+
+            # Statistics merged from other databases, replaced per source on every merge.
+            # context is '' for a source's global statistics
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS merged_word_stats (
+                source TEXT NOT NULL,
+                context TEXT NOT NULL,
+                word TEXT NOT NULL,
+                avg_improvement REAL NOT NULL,
+                max_improvement REAL NOT NULL,
+                avg_token_count REAL NOT NULL,
+                min_token_count INTEGER NOT NULL,
+                use_count INTEGER NOT NULL,
+                best_position TEXT NOT NULL,
+                PRIMARY KEY (source, context, word)
+            )
+            """
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_merged_word_stats_context ON merged_word_stats(context)"
+            )
+
+            # Random id of this database, which tags its exports
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO metadata (key, value) VALUES ('source_id', ?)",
+                (uuid.uuid4().hex,),
+            )
+            self.source_id = cursor.execute(
+                "SELECT value FROM metadata WHERE key = 'source_id'"
+            ).fetchone()[0]
+
+            # Age-based retention deletes by timestamp
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_word_performance_timestamp ON word_performance(timestamp)"
+            )
+
+            # Digests of merged export files, so merging the same file twice is a no-op
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS merged_exports (
+                digest TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                merged_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+            )
+
             self.conn.commit()
             print(f"Database initialized at {self.db_path}")
         except sqlite3.Error as e:
@@ -66,66 +443,88 @@ class WordsDatabase:
         improvement: float,
         token_count: int,
         combined_score: float,
+        context: Optional[str] = None,
     ):
-        """Record the performance of a word when added to a prefix."""
-        if self.conn is None:
-            self.initialize_db()
+        """
+        Record the performance of a word when added to a prefix (buffered, see flush).
+        With a context the record also updates the statistics of that context.
+        """
+        with self._lock:
+            self._pending.append(
+                (word, position, benign_score, improvement, token_count, combined_score, context)
+            )
+            if len(self._pending) < self.buffer_size:
+                return
+        if self._writer is not None:
+            self._wake.set()
+        else:
+            self.flush()
 
-        try:
-            cursor = self.conn.cursor()
+    def flush(self):
+        """Write all pending records in a single transaction."""
+        with self._lock:
+            if not self._pending:
+                return
+            records = self._pending
+            self._pending = []
+            try:
+                if self.conn is None:
+                    self.initialize_db()
+                with self.conn:
+                    self._write_records(self.conn.cursor(), records)
+                    self._apply_retention(self.conn.cursor())
+            except sqlite3.Error as e:
+                dropped = self._requeue(records)
+                print(
+                    f"Error recording word performance: {e} "
+                    f"({len(self._pending)} records kept for the next write, {dropped} dropped)"
+                )
+                # Still try to continue without failing
+                self._indexes.clear()  # Reload from the database on the next query
+                return
+            except BaseException:
+                self._requeue(records)
+                raise
 
-            # Insert performance record
-            cursor.execute(
+            for word, position, _, improvement, token_count, _, context in records:
+                for scope in (None, context) if context else (None,):
+                    if scope in self._indexes:
+                        self._indexes[scope].add(word, position, improvement, token_count)
+
+    def _requeue(self, records: List[Record]) -> int:
+        """
+        Put records that could not be written back in front of the pending ones, keeping at
+        most four buffers' worth; returns the number of oldest records dropped.
+        """
+        self._pending = records + self._pending
+        dropped = max(0, len(self._pending) - self.buffer_size * 4)
+        del self._pending[:dropped]
+        return dropped
+
+    def _write_records(self, cursor: sqlite3.Cursor, records: List[Record]):
+        """Insert raw performance records and fold them into the statistics tables."""
+        # Insert performance records
+        if self.store_raw:
+            cursor.executemany(
                 """
             INSERT INTO word_performance 
-            (word, position, benign_score, improvement, token_count, combined_score)
-            VALUES (?, ?, ?, ?, ?, ?)
+            (word, position, benign_score, improvement, token_count, combined_score, context)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-                (
-                    word,
-                    position,
-                    benign_score,
-                    improvement,
-                    token_count,
-                    combined_score,
-                ),
+                records,
             )
 
-            # Update statistics
-            cursor.execute(
-                """
-            INSERT INTO word_stats 
-            (word, avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position)
-            VALUES (?, ?, ?, ?, ?, 1, ?)
-            ON CONFLICT(word) DO UPDATE SET
-                avg_improvement = (avg_improvement * use_count + ?) / (use_count + 1),
-                max_improvement = MAX(max_improvement, ?),
-                avg_token_count = (avg_token_count * use_count + ?) / (use_count + 1),
-                min_token_count = MIN(min_token_count, ?),
-                use_count = use_count + 1,
-                best_position = CASE WHEN ? > max_improvement THEN ? ELSE best_position END,
-                last_updated = CURRENT_TIMESTAMP
-            """,
-                (
-                    word,
-                    improvement,
-                    improvement,
-                    token_count,
-                    token_count,
-                    position,
-                    improvement,
-                    improvement,
-                    token_count,
-                    token_count,
-                    improvement,
-                    position,
-                ),
-            )
+        # Update global statistics
+        cursor.executemany(
+            STATS_UPSERT.format(table="word_stats", keys="word", key_params="?"),
+            [stats_params((record[0],), record) for record in records],
+        )
 
-            self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error recording word performance: {e}")
-            # Still try to continue without failing
+        # Update per-context statistics
+        cursor.executemany(
+            STATS_UPSERT.format(table="context_word_stats", keys="context, word", key_params="?, ?"),
+            [stats_params((record[6], record[0]), record) for record in records if record[6]],
+        )
 
     def get_top_words(
         self,
@@ -133,6 +532,7 @@ class WordsDatabase:
         min_uses: int = 2,
         sort_by: str = "improvement",
         token_weight: float = 0.0,
+        context: Optional[str] = None,
     ) -> List[str]:
         """
         Get the top-performing words based on selected criteria.
@@ -143,117 +543,352 @@ class WordsDatabase:
         min_uses: Minimum number of uses a word must have to be considered
         sort_by: How to sort the results - options: "improvement", "tokens", "combined"
         token_weight: When sort_by="combined", weight for token count vs improvement (0-1)
+        context: Search context (see context_key) to rank words for; the ranking of the context
+                 comes first and is topped up from the global statistics
 
         Returns:
         --------
         List of words matching the criteria
         """
-        if self.conn is None:
-            self.initialize_db()
+        if context is None:
+            return self._rank_words(limit, min_uses, sort_by, token_weight)
 
-        try:
-            cursor = self.conn.cursor()
+        top_words = self._rank_words(limit, min_uses, sort_by, token_weight, context)
+        if len(top_words) < limit:
+            # Fall back to global statistics for what the context has no history on
+            seen = set(top_words)
+            for word in self._rank_words(limit, min_uses, sort_by, token_weight):
+                if len(top_words) >= limit:
+                    break
+                if word not in seen:
+                    top_words.append(word)
+        return top_words
 
-            # Different sorting strategies
-            if sort_by == "tokens":
-                # Sort by token count (ascending) then by improvement (descending)
-                cursor.execute(
-                    """
-                SELECT word FROM word_stats 
-                WHERE use_count >= ? AND avg_improvement > 0
-                ORDER BY min_token_count ASC, avg_improvement DESC
-                LIMIT ?
-                """,
-                    (min_uses, limit),
-                )
-            elif sort_by == "combined":
-                # Get all qualifying words with their stats
-                cursor.execute(
-                    """
-                SELECT word, avg_improvement, min_token_count 
-                FROM word_stats 
-                WHERE use_count >= ? AND avg_improvement > 0
-                """,
-                    (min_uses,),
+    def _index(self, context: Optional[str] = None) -> WordIndex:
+        """In-memory index of the global statistics, or of one context's statistics."""
+        with self._lock:
+            self.flush()
+            index = self._indexes.get(context)
+            if index is None:
+                columns = "word, avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position"
+                if context is None:
+                    rows = self._query(f"SELECT {columns} FROM word_stats")
+                else:
+                    rows = self._query(
+                        f"SELECT {columns} FROM context_word_stats WHERE context = ?", (context,)
+                    )
+                rows += self._query(
+                    f"SELECT {columns} FROM merged_word_stats WHERE context = ? ORDER BY source",
+                    (context or "",),
                 )
+                index = self._indexes[context] = WordIndex(rows)
+            return index
 
-                # Calculate combined scores
-                results = cursor.fetchall()
-                if not results:
-                    return []
+    def _apply_retention(self, cursor: sqlite3.Cursor) -> int:
+        """Delete raw rows beyond max_rows or older than max_days; returns the number deleted."""
+        deleted = 0
+        if self.max_rows > 0:
+            # Row ids only grow, so the newest rows are the ones with the largest ids
+            cursor.execute(
+                "DELETE FROM word_performance WHERE id <= (SELECT MAX(id) FROM word_performance) - ?",
+                (self.max_rows,),
+            )
+            deleted += cursor.rowcount
+        if self.max_days > 0:
+            # By timestamp rather than id: merged rows keep their original, older timestamps
+            cursor.execute(
+                "DELETE FROM word_performance WHERE timestamp < datetime('now', ?)",
+                (f"-{self.max_days} days",),
+            )
+            deleted += cursor.rowcount
+        return deleted
 
-                # Normalize values
-                max_improvement = max(row[1] for row in results)
-                max_tokens = max(row[2] for row in results)
-
-                # Calculate combined score for each word
-                scored_words = []
-                for row in results:
-                    word = row[0]
-                    norm_improvement = row[1] / max_improvement if max_improvement > 0 else 0
-                    norm_tokens = 1 - (
-                        row[2] / max_tokens if max_tokens > 0 else 0
-                    )  # Invert so lower is better
-                    combined_score = (
-                        1 - token_weight
-                    ) * norm_improvement + token_weight * norm_tokens
-                    scored_words.append((word, combined_score))
-
-                # Sort by combined score and return top words
-                scored_words.sort(key=lambda x: x[1], reverse=True)
-                return [word for word, _ in scored_words[:limit]]
-            else:
-                # Default: sort by improvement
-                cursor.execute(
+    def compact(self, rebuild: bool = False) -> Dict[str, int]:
+        """
+        Apply the retention limits, optionally rebuild the statistics from the raw rows, and
+        vacuum the file to return the freed space to the file system.
+
+        Parameters:
+        -----------
+        rebuild: Recompute word_stats and context_word_stats from the local raw rows. The statistics
+                 then only reflect the retained rows, so this discards the history of pruned rows
+
+        Returns:
+        --------
+        Number of deleted raw rows and of rebuilt statistics rows
+        """
+        with self._lock:
+            self.flush()
+            result: Dict[str, int] = {}
+            with self.conn:
+                cursor = self.conn.cursor()
+                result["deleted_rows"] = self._apply_retention(cursor)
+                if rebuild:
+                    if not cursor.execute(
+                        "SELECT 1 FROM word_performance WHERE source IS NULL LIMIT 1"
+                    ).fetchone():
+                        raise ValueError("No raw rows to rebuild the statistics from")
+                    # best_position comes from the first row with the highest improvement,
+                    # the row that set it in the live statistics
+                    ranked = """
+                    WITH ranked AS (
+                        SELECT *, ROW_NUMBER() OVER (
+                            PARTITION BY {partition} ORDER BY improvement DESC, id
+                        ) AS rank
+                        FROM word_performance WHERE source IS NULL {where}
+                    )
+                    SELECT {partition}, AVG(improvement), MAX(improvement), AVG(token_count),
+                    MIN(token_count), COUNT(*), MAX(CASE WHEN rank = 1 THEN position END)
+                    FROM ranked GROUP BY {partition}
                     """
-                SELECT word FROM word_stats 
-                WHERE use_count >= ? AND avg_improvement > 0
-                ORDER BY avg_improvement DESC
-                LIMIT ?
-                """,
-                    (min_uses, limit),
-                )
+                    cursor.execute("DELETE FROM word_stats")
+                    cursor.execute(
+                        """
+                    INSERT INTO word_stats
+                    (word, avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position)
+                    """
+                        + ranked.format(partition="word", where="")
+                    )
+                    result["word_stats"] = cursor.rowcount
+                    cursor.execute("DELETE FROM context_word_stats")
+                    cursor.execute(
+                        """
+                    INSERT INTO context_word_stats
+                    (context, word, avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position)
+                    """
+                        + ranked.format(partition="context, word", where="AND context IS NOT NULL")
+                    )
+                    result["context_word_stats"] = cursor.rowcount
+                    self._indexes.clear()
+
+            self.conn.execute("VACUUM")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return result
 
-            results = cursor.fetchall()
-            return [row[0] for row in results]
+    def _rank_words(
+        self,
+        limit: int,
+        min_uses: int,
+        sort_by: str,
+        token_weight: float,
+        context: Optional[str] = None,
+    ) -> List[str]:
+        """Top words of the global statistics, or of one context's statistics."""
+        try:
+            with self._lock:
+                return self._index(context).top(limit, min_uses, sort_by, token_weight)
         except sqlite3.Error as e:
             print(f"Error getting top words: {e}")
             return []
 
-    def get_word_stats(self, word: str) -> Optional[Dict[str, Any]]:
-        """Get statistics for a specific word."""
-        if self.conn is None:
-            self.initialize_db()
-
+    def get_word_stats(self, word: str, context: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Get statistics for a specific word, from the given context if it has used the word."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                """
-            SELECT word, avg_improvement, max_improvement, avg_token_count, min_token_count, use_count, best_position
-            FROM word_stats 
-            WHERE word = ?
-            """,
-                (word,),
-            )
-
-            result = cursor.fetchone()
-            if result:
+            with self._lock:
+                values = None
+                if context is not None:
+                    values = self._index(context).stats.get(word)
+                if values is None:
+                    values = self._index().stats.get(word)
+                if values is None:
+                    return None
                 return {
-                    "word": result[0],
-                    "avg_improvement": result[1],
-                    "max_improvement": result[2],
-                    "avg_token_count": result[3],
-                    "min_token_count": result[4],
-                    "use_count": result[5],
-                    "best_position": result[6],
+                    "word": word,
+                    "avg_improvement": values[0],
+                    "max_improvement": values[1],
+                    "avg_token_count": values[2],
+                    "min_token_count": values[3],
+                    "use_count": values[4],
+                    "best_position": values[5],
                 }
-            return None
         except sqlite3.Error as e:
             print(f"Error getting word stats: {e}")
             return None
 
+    def export_npz(self, path: str, include_raw: bool = False) -> Dict[str, int]:
+        """
+        Export the locally recorded word statistics to a compressed NumPy .npz file with one
+        array per column, tagged with the id of this database.
+
+        Parameters:
+        -----------
+        path: Output file
+        include_raw: Also export the local raw word_performance rows
+
+        Returns:
+        --------
+        Number of exported rows per table
+        """
+        arrays: Dict[str, np.ndarray] = {"source": np.array(self.source_id, dtype=np.str_)}
+        counts: Dict[str, int] = {}
+        tables = [
+            ("stats", "word_stats", ["word"] + STATS_COLUMNS, ""),
+            ("context", "context_word_stats", ["context", "word"] + STATS_COLUMNS, ""),
+        ]
+        if include_raw:
+            tables.append(("raw", "word_performance", RAW_COLUMNS, "WHERE source IS NULL"))
+
+        for prefix, table, columns, where in tables:
+            rows = self._query(f"SELECT {', '.join(columns)} FROM {table} {where}")
+            counts[table] = len(rows)
+            for column, values in zip(columns, zip(*rows) if rows else [()] * len(columns)):
+                if column in ("word", "position", "best_position", "context", "timestamp"):
+                    arrays[f"{prefix}/{column}"] = np.array(
+                        ["" if value is None else str(value) for value in values], dtype=np.str_
+                    )
+                elif column in ("min_token_count", "use_count", "token_count"):
+                    arrays[f"{prefix}/{column}"] = np.array(values, dtype=np.int64)
+                else:
+                    arrays[f"{prefix}/{column}"] = np.array(values, dtype=np.float64)
+
+        np.savez_compressed(path, **arrays)
+        return counts
+
+    def merge_npz(self, path: str) -> Dict[str, int]:
+        """
+        Merge an export_npz file into this database. The file's statistics replace whatever was
+        merged from the same source database before, and are combined with the local and other
+        merged statistics with use-count-weighted averages; raw rows, if exported, replace that
+        source's earlier raw rows.
+
+        Parameters:
+        -----------
+        path: File written by export_npz
+
+        Returns:
+        --------
+        Number of merged rows per table (empty if the file was merged before or is an export of
+        this database)
+        """
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        with np.load(path) as data, self._lock:
+            self.flush()
+            if self.conn.execute(
+                "SELECT 1 FROM merged_exports WHERE digest = ?", (digest,)
+            ).fetchone():
+                print(f"{path} was already merged, skipping")
+                return {}
+            # Files exported before sources were tagged count as their own source
+            source = str(data["source"]) if "source" in data else digest
+            if source == self.source_id:
+                print(f"{path} is an export of this database, skipping")
+                return {}
+
+            def rows(prefix: str, columns: List[str]) -> List[Tuple]:
+                if f"{prefix}/{columns[0]}" not in data:
+                    return []
+                values = [data[f"{prefix}/{column}"].tolist() for column in columns]
+                return list(zip(*values))
+
+            stats_rows = [
+                (source, "") + row for row in rows("stats", ["word"] + STATS_COLUMNS)
+            ]
+            context_rows = [
+                (source,) + row for row in rows("context", ["context", "word"] + STATS_COLUMNS)
+            ]
+            raw_rows = [
+                row[:6] + (row[6] or None,) + (row[7] or None,) + (source,)
+                for row in rows("raw", RAW_COLUMNS)
+            ]
+
+            with self.conn:
+                cursor = self.conn.cursor()
+                cursor.execute("DELETE FROM merged_word_stats WHERE source = ?", (source,))
+                cursor.executemany(
+                    f"""
+                INSERT INTO merged_word_stats (source, context, word, {', '.join(STATS_COLUMNS)})
+                VALUES (?, ?, ?, {', '.join('?' for _ in STATS_COLUMNS)})
+                """,
+                    stats_rows + context_rows,
+                )
+                if raw_rows:
+                    cursor.execute("DELETE FROM word_performance WHERE source = ?", (source,))
+                cursor.executemany(
+                    f"""
+                INSERT INTO word_performance ({', '.join(RAW_COLUMNS)}, source)
+                VALUES ({', '.join('?' for _ in RAW_COLUMNS)}, ?)
+                """,
+                    raw_rows,
+                )
+                cursor.execute(
+                    "INSERT INTO merged_exports (digest, path) VALUES (?, ?)", (digest, path)
+                )
+
+            # Reload the rankings with the merged statistics
+            self._indexes.clear()
+        return {
+            "word_stats": len(stats_rows),
+            "context_word_stats": len(context_rows),
+            "word_performance": len(raw_rows),
+        }
+
+    def _query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        """Run a read query after writing pending records, so reads see every record."""
+        with self._lock:
+            self.flush()
+            if self.conn is None:
+                self.initialize_db()
+            return self.conn.execute(sql, params).fetchall()
+
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        """Write pending records and close the database connection."""
+        self._stop_writer()
+        with self._lock:
+            self.flush()
+            if self._pending:
+                print(f"Could not write {len(self._pending)} word performance records")
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share word statistics between databases")
+    parser.add_argument("--db", type=str, default="word_performance.db", help="Database file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export word statistics to a .npz file")
+    export_parser.add_argument("path", type=str, help="Output .npz file")
+    export_parser.add_argument(
+        "--raw", action="store_true", help="Also export the raw word_performance rows"
+    )
+
+    merge_parser = subparsers.add_parser("merge", help="Merge .npz exports into the database")
+    merge_parser.add_argument("paths", type=str, nargs="+", help=".npz files written by export")
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Prune raw rows, optionally rebuild statistics, and vacuum"
+    )
+    compact_parser.add_argument("--max-rows", type=int, default=0, help="Keep the newest N raw rows")
+    compact_parser.add_argument(
+        "--max-days", type=float, default=0, help="Keep raw rows younger than N days"
+    )
+    compact_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Recompute the statistics from the retained raw rows",
+    )
+
+    args = parser.parse_args()
+
+    db = WordsDatabase(args.db)
+    try:
+        if args.command == "export":
+            counts = db.export_npz(args.path, include_raw=args.raw)
+            print(f"Exported {counts} to {args.path}")
+        elif args.command == "compact":
+            db.configure(max_rows=args.max_rows, max_days=args.max_days)
+            print(f"Compacted {args.db}: {db.compact(rebuild=args.rebuild)}")
+        else:
+            for path in args.paths:
+                counts = db.merge_npz(path)
+                if counts:
+                    print(f"Merged {counts} from {path}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Long-lived worker that keeps the classifier, tokenizer and word database resident and runs
+optimization jobs against them, so the model load is paid once instead of once per job.
+
+Jobs are JSON objects, one per line, read from stdin or from a Unix socket connection:
+
+    {"id": "job-1", "injection": "...", "mandatory_text": "...", "config": {"optimization": {"alpha": 0.5}}}
+
+"injection" and "mandatory_text" default to the values in config.yaml. "config" uses the same
+sections as config.yaml and overrides them for this job only, except for what the worker sets up
+once at startup: the "model" and "cache" sections and the "database" section apart from
+context_stats. Jobs that override those get an "error" event. For every job the worker streams
+back JSON lines: one "progress" event per trajectory per iteration (unless "progress" is false)
+followed by a single "result" or "error" event.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import socketserver
+import stat
+import sys
+import traceback
+from typing import Any, Callable, Dict, IO
+
+
+def run_job(job: Dict[str, Any], emit: Callable[[Dict[str, Any]], None]) -> None:
+    """Run a single job and emit its progress and result events."""
+    # Loaded by main() under a stdout redirect, so this import is free
+    from hacking import load_settings, optimize, text_config
+
+    job_id = job.get("id")
+    try:
+        settings: Dict[str, Any] = load_settings(job.get("config"))
+
+        def on_progress(event: Dict[str, Any]) -> None:
+            emit({"id": job_id, **event})
+
+        result: Dict[str, Any] = optimize(
+            job.get("injection", text_config["injection"]),
+            job.get("mandatory_text", text_config["mandatory"]),
+            settings,
+            on_progress=on_progress if job.get("progress", True) else None,
+        )
+        emit({"id": job_id, "event": "result", **result})
+    except Exception as e:
+        traceback.print_exc()
+        emit({"id": job_id, "event": "error", "error": str(e)})
+
+
+def serve_lines(lines, out: IO[str]) -> None:
+    """Process JSON job lines from an iterable, writing JSON event lines to out."""
+
+    def emit(event: Dict[str, Any]) -> None:
+        out.write(json.dumps(event) + "\n")
+        out.flush()
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job: Dict[str, Any] = json.loads(line)
+        except json.JSONDecodeError as e:
+            emit({"event": "error", "error": f"Invalid job line: {e}"})
+            continue
+        run_job(job, emit)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Serve the jobs of one socket connection; connections are handled one at a time."""
+
+    def handle(self):
+        out = _SocketWriter(self.wfile)
+        serve_lines(self.rfile, out)
+
+
+class _SocketWriter:
+    """Text adapter over the binary socket stream."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data: str) -> None:
+        self.wfile.write(data.encode("utf-8"))
+
+    def flush(self) -> None:
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm optimization worker")
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Listen on this Unix socket path instead of reading jobs from stdin",
+    )
+    args = parser.parse_args()
+
+    # Loading the model, tokenizer and word database prints progress; in stdin mode stdout
+    # carries only the JSON events, so those logs go to stderr as well
+    with contextlib.nullcontext() if args.socket else contextlib.redirect_stdout(sys.stderr):
+        import hacking
+
+    if args.socket:
+        # Remove a stale socket left behind by a previous worker
+        if os.path.exists(args.socket) and stat.S_ISSOCK(os.stat(args.socket).st_mode):
+            os.remove(args.socket)
+        print(f"Worker listening on {args.socket}")
+        with socketserver.UnixStreamServer(args.socket, JobHandler) as server:
+            server.serve_forever()
+    else:
+        # stdout carries the JSON events, so the optimizer's logs go to stderr
+        out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            serve_lines(sys.stdin, out)
+
+
+if __name__ == "__main__":
+    main()